@@ -0,0 +1,152 @@
+#/usr/bin/env python
+
+import pickle
+import time
+from multiprocessing import Pool, cpu_count
+from xml.etree import ElementTree
+from xmlmixin import _xmlbehavior
+
+default_chunk_size = 256
+default_min_parallel = 2048
+
+_schemas = {}
+
+def _schema(blob):
+    if blob not in _schemas:
+        _schemas[blob] = pickle.loads(blob)
+    return _schemas[blob]
+
+def _to_xml_all(behavior, objects):
+    return [ElementTree.tostring(obj.to_xml(behavior = behavior)) for obj in objects]
+
+def _to_xml_chunk(args):
+    blob, objects = args
+    return _to_xml_all(_schema(blob), objects)
+
+def _type_match_all(type_definition, values):
+    return [type_definition.type_match(val) for val in values]
+
+def _type_match_chunk(args):
+    blob, values = args
+    return _type_match_all(_schema(blob), values)
+
+def chunks(items, chunk_size):
+    return [items[i:i + chunk_size] for i in xrange(0, len(items), chunk_size)]
+
+def _run(function, chunk_function, schema, items, chunk_size, workers, min_parallel, pool):
+    items = list(items)
+    chunk_size = max(1, chunk_size)
+    if workers is None:
+        workers = cpu_count()
+    if pool is None and (workers <= 1 or len(items) < min_parallel):
+        return function(schema, items)
+
+    blob = pickle.dumps(schema, pickle.HIGHEST_PROTOCOL)
+    work = [(blob, chunk) for chunk in chunks(items, chunk_size)]
+    if pool is not None:
+        results = pool.map(chunk_function, work, 1)
+    else:
+        pool = Pool(workers)
+        try:
+            results = pool.map(chunk_function, work, 1)
+        finally:
+            pool.close()
+            pool.join()
+    return [result for chunk in results for result in chunk]
+
+def to_xml(objects, behavior = _xmlbehavior(), chunk_size = default_chunk_size, workers = None,
+        min_parallel = default_min_parallel, pool = None):
+    return _run(_to_xml_all, _to_xml_chunk, behavior, objects, chunk_size, workers, min_parallel, pool)
+
+def type_match(type_definition, values, chunk_size = default_chunk_size, workers = None,
+        min_parallel = default_min_parallel, pool = None):
+    return _run(_type_match_all, _type_match_chunk, type_definition, values, chunk_size, workers, min_parallel, pool)
+
+def scaling(function, items, worker_counts = (1, 2, 4), *args, **kwargs):
+    rval = []
+    items = list(items)
+    for workers in worker_counts:
+        start = time.time()
+        function(*(args + (items, )), workers = workers, min_parallel = 0, **kwargs)
+        elapsed = max(time.time() - start, 1e-9)
+        rval.append((workers, len(items) / elapsed))
+    return rval
+
+if __name__ == '__main__':
+
+    import sys
+    import unittest
+    from magic import Object, Property
+    from caching import ValidationCache
+    from type_definition import TypeDefinition, Specification
+    from xmlmixin import _xml
+    from utils import replace_none
+
+    class record(Object, _xml):
+        key = Property(int)
+        names = Property([str])
+        scores = Property({str: float})
+
+        def __init__(self, key = 0, names = None, scores = None):
+            super(record, self).__init__()
+            self.key = key
+            self.names = replace_none(names, [])
+            self.scores = replace_none(scores, {})
+
+    def records(n):
+        return [record(i, ['r%d' % i, 'x'], {'s': i / 2.0}) for i in xrange(n)]
+
+    class BulkTests(unittest.TestCase):
+
+        def test_chunks(self):
+            self.assertEqual(chunks(range(5), 2), [[0, 1], [2, 3], [4]])
+            self.assertEqual(chunks([], 2), [])
+
+        def test_to_xml_in_process(self):
+            objects = records(10)
+            self.assertEqual(to_xml(objects), [ElementTree.tostring(i.to_xml()) for i in objects])
+
+        def test_in_process_schema(self):
+            cache = ValidationCache()
+            type_definition = TypeDefinition(Specification(str, validation = lambda val: len(val) == 3), cache = cache)
+            self.assertEqual(type_match(type_definition, ['abc', 'ab', 'abc']), [True, False, True])
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        def test_to_xml_parallel(self):
+            objects = records(50)
+            serialized = to_xml(objects, chunk_size = 7, workers = 2, min_parallel = 0)
+            self.assertEqual(serialized, [ElementTree.tostring(i.to_xml()) for i in objects])
+            self.assertEqual(record.from_xml(ElementTree.fromstring(serialized[42])).key, 42)
+
+        def test_type_match_parallel(self):
+            type_definition = TypeDefinition([{(int, int): str}])
+            values = [[{(i, i): 'a'}] if i % 3 else [{(i, 'i'): 'a'}] for i in xrange(30)]
+            self.assertEqual(type_match(type_definition, values, chunk_size = 4, workers = 2, min_parallel = 0),
+                [bool(i % 3) for i in xrange(30)])
+            self.assertEqual(type_match(type_definition, values), [bool(i % 3) for i in xrange(30)])
+
+        def test_shared_pool(self):
+            pool = Pool(2)
+            try:
+                type_definition = TypeDefinition(int)
+                self.assertEqual(type_match(type_definition, [1, 'a', 2], chunk_size = 1, pool = pool),
+                    [True, False, True])
+                self.assertEqual(type_match(type_definition, [3, 4.0], chunk_size = 1, pool = pool),
+                    [True, False])
+            finally:
+                pool.close()
+                pool.join()
+
+        def test_scaling(self):
+            rval = scaling(to_xml, records(20), (1, 2), chunk_size = 5)
+            self.assertEqual([workers for workers, throughput in rval], [1, 2])
+            self.assertTrue(all(throughput > 0 for workers, throughput in rval))
+
+    if '--benchmark' in sys.argv:
+        for workers, throughput in scaling(to_xml, records(20000), (1, 2, 4)):
+            print 'to_xml      %d workers: %10.0f objects/s' % (workers, throughput)
+        values = [[{(i, j): 'v'} for j in xrange(20)] for i in xrange(20000)]
+        for workers, throughput in scaling(type_match, values, (1, 2, 4), TypeDefinition([{(int, int): str}])):
+            print 'type_match  %d workers: %10.0f values/s' % (workers, throughput)
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(BulkTests))
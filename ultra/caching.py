@@ -0,0 +1,200 @@
+#/usr/bin/env python
+
+import threading
+from collections import OrderedDict
+from persistent import PersistentVector, PersistentMap
+
+_scalars = frozenset([str, unicode, int, long, float, complex, bool, type(None)])
+
+def cache_key(val):
+    cls = type(val)
+    if cls in _scalars:
+        return (cls, val)
+    elif cls is tuple:
+        return (cls, tuple([cache_key(i) for i in val]))
+    elif cls is frozenset:
+        return (cls, frozenset([cache_key(i) for i in val]))
+    elif cls is PersistentVector:
+        return (cls, tuple([cache_key(i) for i in val]))
+    elif cls is PersistentMap:
+        return (cls, frozenset([(cache_key(k), cache_key(v)) for k, v in val.iteritems()]))
+    elif getattr(val, '__ultra_sealed__', False):
+        return (cls, tuple([cache_key(val.__dict__.get(property_name))
+            for property_name, type_description in cls._sorted_properties()]))
+    raise TypeError('%s values are not cached' % cls.__name__)
+
+class ValidationCache(object):
+
+    def __init__(self, maxsize = 1024):
+        if maxsize < 1:
+            raise ValueError('cache size must be at least 1, not %d' % maxsize)
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._validations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncached = 0
+        self.clears = 0
+
+    def type_match(self, type_definition, val):
+        try:
+            key = (type_definition, cache_key(val))
+        except TypeError:
+            with self._lock:
+                self.uncached += 1
+            return type_definition._type_match(val)
+        validation = type_definition.restrictions.get('validation')
+        with self._lock:
+            if self._validations.get(type_definition, validation) is not validation:
+                self._clear()
+            self._validations[type_definition] = validation
+            if key in self._entries:
+                rval = self._entries.pop(key)
+                self._entries[key] = rval
+                self.hits += 1
+                return rval
+        rval = type_definition._type_match(val)
+        with self._lock:
+            if self._validations.get(type_definition) is validation:
+                self.misses += 1
+                self._entries.pop(key, None)
+                while len(self._entries) >= self.maxsize:
+                    self._entries.popitem(last = False)
+                    self.evictions += 1
+                self._entries[key] = rval
+        return rval
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._entries = OrderedDict()
+        self.clears += 1
+
+    def stats(self):
+        return { 'size' : len(self), 'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions,
+                 'uncached' : self.uncached, 'clears' : self.clears }
+
+    def __reduce__(self):
+        return (ValidationCache, (self.maxsize, ))
+
+if __name__ == '__main__':
+
+    import pickle
+    import unittest
+    from magic import Object, Property, Identity
+    from type_definition import TypeDefinition, Specification
+
+    checked = []
+
+    def counted(val):
+        checked.append(val)
+        return val[0] <= val[1]
+
+    cell_cache = ValidationCache(16)
+
+    class grid(Object):
+        cells = Property({Specification((int, int), validation = counted, cache = cell_cache): str})
+        corner = Property(Specification((int, int), validation = counted, cache = cell_cache))
+
+        def __init__(self):
+            super(grid, self).__init__()
+            self.cells = {}
+            self.corner = (0, 0)
+
+    class item(Object):
+        __ultra_frozen__ = True
+
+        name = Identity(str)
+        price = Property(int)
+
+        def __init__(self, name = '', price = 0):
+            super(item, self).__init__()
+            self.name = name
+            self.price = price
+
+    class CacheTests(unittest.TestCase):
+
+        def setUp(self):
+            del checked[:]
+
+        def test_mapping_keys(self):
+            i = grid()
+            for k in xrange(100):
+                i.cells[(1, 2)] = 'a'
+                i.cells[(3, 4)] = 'b'
+                i.corner = (1, 2)
+            self.assertEqual(sorted(checked), [(0, 0), (1, 2), (1, 2), (3, 4)])
+            self.assertRaises(TypeError, i.cells.__setitem__, (2, 1), 'c')
+            self.assertRaises(TypeError, i.cells.__setitem__, (2, 1), 'c')
+            self.assertEqual(checked.count((2, 1)), 1)
+
+        def test_types(self):
+            cache = ValidationCache()
+            type_definition = TypeDefinition(Specification((int, int), validation = counted), cache = cache)
+            self.assertTrue(type_definition.type_match((1, 2)))
+            self.assertFalse(type_definition.type_match((1.0, 2)))
+            self.assertFalse(type_definition.type_match((1L, 2)))
+            self.assertTrue(type_definition.type_match((1, 2)))
+            self.assertEqual(cache.stats()['hits'], 1)
+            self.assertEqual(cache.stats()['misses'], 3)
+            self.assertFalse(type_definition.type_match([1, 2]))
+            self.assertEqual(cache.stats()['uncached'], 1)
+
+        def test_lru(self):
+            cache = ValidationCache(2)
+            type_definition = TypeDefinition(str, validation = lambda val: checked.append(val) or True,
+                cache = cache)
+            for val in ['a', 'b', 'a', 'c', 'a', 'b']:
+                type_definition.type_match(val)
+            self.assertEqual(checked, ['a', 'b', 'c', 'b'])
+            self.assertEqual(cache.stats()['evictions'], 2)
+            self.assertEqual(len(cache), 2)
+
+        def test_validator_change(self):
+            cache = ValidationCache()
+            type_definition = TypeDefinition(int, validation = lambda val: val > 0, cache = cache)
+            shared = TypeDefinition(int, validation = lambda val: val < 0, cache = cache)
+            self.assertTrue(type_definition.type_match(1))
+            self.assertFalse(shared.type_match(1))
+            type_definition.restrictions['validation'] = lambda val: val > 1
+            self.assertFalse(type_definition.type_match(1))
+            self.assertEqual(cache.stats()['clears'], 1)
+            self.assertTrue(TypeDefinition(int, cache = True).type_match(1))
+            self.assertEqual(TypeDefinition(int, cache = False)._cache, None)
+            self.assertRaises(ValueError, TypeDefinition, int, cache = 0)
+
+        def test_frozen(self):
+            cache = ValidationCache()
+            type_definition = TypeDefinition(item, validation = lambda val: val.price > 0, cache = cache)
+            self.assertTrue(type_definition.type_match(item('a', 5)))
+            self.assertFalse(type_definition.type_match(item('a', -1)))
+            self.assertFalse(type_definition.type_match(item('a', -1)))
+            self.assertTrue(type_definition.type_match(item('a', 5)))
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        def test_threads(self):
+            cache = ValidationCache(8)
+            type_definition = TypeDefinition(int, validation = lambda val: val >= 0, cache = cache)
+            def run(n):
+                for i in xrange(2000):
+                    assert type_definition.type_match((i * n) % 13)
+            threads = [threading.Thread(target = run, args = (n, )) for n in xrange(1, 5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(cache.hits + cache.misses, 8000)
+            self.assertTrue(len(cache) <= 8)
+
+        def test_pickle(self):
+            self.assertEqual(len(pickle.loads(pickle.dumps(cell_cache))), 0)
+            self.assertEqual(pickle.loads(pickle.dumps(cell_cache)).maxsize, 16)
+
+    unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(CacheTests))
@@ -0,0 +1,152 @@
+#/usr/bin/env python
+
+import threading
+import time
+
+class InstanceState(object):
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.local = threading.local()
+
+    def deferred(self):
+        return getattr(self.local, 'depth', 0) > 0
+
+    def checked_call(self, instance, method, args, kwargs):
+        local = self.local
+        with self.lock:
+            local.depth = getattr(local, 'depth', 0) + 1
+            try:
+                t = method(*args, **kwargs)
+            finally:
+                local.depth -= 1
+                if local.depth == 0:
+                    instance.__ultra_invariant_checks__ = True
+                    instance.__ultra_do_invariant_checks__()
+            return t
+
+def stress(target, threads, iterations):
+    start = threading.Event()
+    def run(n):
+        start.wait()
+        for i in xrange(iterations):
+            target(n, i)
+    workers = [threading.Thread(target = run, args = (n, )) for n in xrange(threads)]
+    for worker in workers:
+        worker.start()
+    began = time.time()
+    start.set()
+    for worker in workers:
+        worker.join()
+    return time.time() - began
+
+if __name__ == '__main__':
+
+    import sys
+    import unittest
+    from magic import Object, Property, Invariant
+
+    class account(Object):
+        __ultra_concurrent__ = True
+
+        debit = Property(int)
+        credit = Property(int)
+        entries = Property([int])
+        note = Property(str)
+
+        def __init__(self):
+            super(account, self).__init__()
+            self.debit = 0
+            self.credit = 0
+            self.entries = []
+            self.note = ''
+
+        @Invariant
+        def balanced(self):
+            return self.debit == self.credit and len(self.entries) == self.debit
+
+        def post(self, amount, pause = None):
+            self.debit += amount
+            if pause is not None:
+                pause.set()
+                time.sleep(0.05)
+            self.credit += amount
+            for i in xrange(amount):
+                self.entries.append(i)
+
+    class ledger(Object):
+        __ultra_concurrent__ = True
+
+        lines = Property([str])
+
+        def __init__(self):
+            super(ledger, self).__init__()
+            self.lines = []
+
+    class plain_ledger(Object):
+
+        lines = Property([str])
+
+        def __init__(self):
+            super(plain_ledger, self).__init__()
+            self.lines = []
+
+    class ConcurrencyTests(unittest.TestCase):
+
+        def test_per_thread_deferral(self):
+            i = account()
+            pause = threading.Event()
+            worker = threading.Thread(target = i.post, args = (3, pause))
+            worker.start()
+            pause.wait()
+            i.note = 'written while post() was running'
+            worker.join()
+            self.assertEqual((i.debit, i.credit, len(i.entries)), (3, 3, 3))
+            self.assertRaises(ValueError, setattr, i, 'debit', 4)
+
+        def test_deferral_is_not_shared(self):
+            i = account()
+            errors = []
+            pause = threading.Event()
+            def violate():
+                pause.wait()
+                try:
+                    i.credit = 10
+                except ValueError:
+                    errors.append(True)
+            worker = threading.Thread(target = violate)
+            worker.start()
+            i.post(1, pause)
+            worker.join()
+            self.assertEqual(errors, [True])
+
+        def test_atomic_proxy_mutation(self):
+            i = ledger()
+            stress(lambda n, k: i.lines.append('%d:%d' % (n, k)), 8, 500)
+            self.assertEqual(len(i.lines), 8 * 500)
+            self.assertRaises(TypeError, i.lines.append, 1)
+
+        def test_pickle(self):
+            import pickle
+            i = pickle.loads(pickle.dumps(account(), 2))
+            i.post(2)
+            self.assertEqual(i.entries, [0, 1])
+            self.assertRaises(ValueError, setattr, i, 'credit', 1)
+
+    if '--benchmark' in sys.argv:
+        coarse = threading.Lock()
+        objects = [ledger() for i in xrange(64)]
+        plain = [plain_ledger() for i in xrange(64)]
+        def fine_grained(n, k):
+            objects[(n * 7 + k) % 64].lines.append('x')
+            objects[(n + k) % 64].lines
+        def global_lock(n, k):
+            with coarse:
+                plain[(n * 7 + k) % 64].lines.append('x')
+                plain[(n + k) % 64].lines
+        for threads in (1, 2, 4, 8):
+            for name, target in (('per-instance', fine_grained), ('global', global_lock)):
+                elapsed = stress(target, threads, 20000)
+                print '%-12s %d threads: %10.0f ops/s' % (name, threads, threads * 20000 / elapsed)
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(ConcurrencyTests))
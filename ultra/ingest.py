@@ -0,0 +1,282 @@
+#/usr/bin/env python
+
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+
+class RecordParser(object):
+
+    def __init__(self):
+        self._builder = ElementTree.TreeBuilder()
+        self._parser = ElementTree.XMLParser(target = self)
+        self._depth = 0
+        self._root = None
+        self._records = []
+
+    def start(self, tag, attrib):
+        self._depth += 1
+        element = self._builder.start(tag, attrib)
+        if self._depth == 1:
+            self._root = element
+        return element
+
+    def end(self, tag):
+        self._depth -= 1
+        element = self._builder.end(tag)
+        if self._depth == 1:
+            self._root.remove(element)
+            self._records.append(element)
+        return element
+
+    def data(self, data):
+        self._builder.data(data)
+
+    def close(self):
+        return self._builder.close()
+
+    def _take(self):
+        records, self._records = self._records, []
+        return records
+
+    def feed(self, data):
+        self._parser.feed(data)
+        return self._take()
+
+    def finish(self):
+        self._parser.close()
+        return self._take()
+
+class _Built(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+class _Result(object):
+
+    def __init__(self, on_ready = None):
+        self._event = threading.Event()
+        self._on_ready = on_ready
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+        self._event.set()
+        if self._on_ready is not None:
+            self._on_ready()
+
+    def ready(self):
+        return self._event.is_set()
+
+    def get(self):
+        self._event.wait()
+        return self.value
+
+def _build(cls, record, behavior):
+    return cls.from_xml(record, behavior)
+
+def _build_safely(cls, record, behavior):
+    try:
+        return True, _build(cls, record, behavior)
+    except Exception, e:
+        return False, e
+
+def _read(stream, chunk_size):
+    if hasattr(stream, 'read'):
+        while True:
+            data = stream.read(chunk_size)
+            if not data:
+                return
+            yield data
+    else:
+        for data in stream:
+            yield data
+
+def heavy_records(minimum_elements):
+    return lambda record: sum(1 for i in record.iter()) >= minimum_elements
+
+class Ingester(object):
+
+    def __init__(self, cls, pool = None, workers = 2, max_in_flight = 64, behavior = None, heavy = None,
+            on_ready = None):
+        self.cls = cls
+        self.max_in_flight = max_in_flight
+        self.behavior = behavior
+        self.heavy = heavy
+        self.on_ready = on_ready
+        self._own_pool = pool is None
+        self._pool = ThreadPool(workers) if pool is None else pool
+        self._parser = RecordParser()
+        self._waiting = deque()
+        self._in_flight = deque()
+
+    def feed(self, data):
+        self._waiting.extend(self._parser.feed(data))
+        return self.poll()
+
+    def finish(self):
+        self._waiting.extend(self._parser.finish())
+        return self.poll()
+
+    def poll(self):
+        rval = []
+        while True:
+            self._submit()
+            if not self._in_flight or not self._in_flight[0].ready():
+                return rval
+            while self._in_flight and self._in_flight[0].ready():
+                if rval and not self._in_flight[0].get()[0]:
+                    return rval
+                rval.append(self._take())
+
+    def wait(self):
+        self._submit()
+        return self._take()
+
+    def blocked(self):
+        return bool(self._waiting)
+
+    def pending(self):
+        return len(self._waiting) + len(self._in_flight)
+
+    def close(self):
+        if self._own_pool:
+            self._pool.close()
+            self._pool.join()
+
+    def _submit(self):
+        while self._waiting and len(self._in_flight) < self.max_in_flight:
+            record = self._waiting.popleft()
+            if self.heavy is None or self.heavy(record):
+                result = _Result(self.on_ready)
+                self._pool.apply_async(_build_safely, (self.cls, record, self.behavior), callback = result.set)
+            else:
+                result = _Built(_build_safely(self.cls, record, self.behavior))
+            self._in_flight.append(result)
+
+    def _take(self):
+        success, value = self._in_flight.popleft().get()
+        if not success:
+            raise value
+        return value
+
+def ingest(cls, stream, pool = None, workers = 2, max_in_flight = 64, chunk_size = 65536,
+        behavior = None, heavy = None):
+    ingester = Ingester(cls, pool, workers, max_in_flight, behavior, heavy)
+    try:
+        for data in _read(stream, chunk_size):
+            for obj in ingester.feed(data):
+                yield obj
+            while ingester.blocked():
+                yield ingester.wait()
+        for obj in ingester.finish():
+            yield obj
+        while ingester.pending():
+            yield ingester.wait()
+    finally:
+        ingester.close()
+
+if __name__ == '__main__':
+
+    import unittest
+    from StringIO import StringIO
+    from magic import Object, Property
+    from xmlmixin import _xml
+    from utils import replace_none
+
+    class record(Object, _xml):
+        key = Property(int)
+        values = Property([float])
+
+        def __init__(self, key = 0, values = None):
+            super(record, self).__init__()
+            self.key = key
+            self.values = replace_none(values, [])
+
+    def document(n):
+        return '<records>%s</records>' % ''.join(
+            ElementTree.tostring(record(i, [i / 2.0] * (i % 5)).to_xml()) for i in xrange(n))
+
+    class IngestTests(unittest.TestCase):
+
+        def test_parser(self):
+            parser = RecordParser()
+            data = document(3)
+            records = parser.feed(data[:40]) + parser.feed(data[40:]) + parser.finish()
+            self.assertEqual([i.tag for i in records], ['record'] * 3)
+            self.assertEqual([i.find('key').text for i in records], ['0', '1', '2'])
+
+        def test_ordered(self):
+            data = document(50)
+            chunks = [data[i:i + 7] for i in xrange(0, len(data), 7)]
+            objects = list(ingest(record, chunks, max_in_flight = 4))
+            self.assertEqual([i.key for i in objects], range(50))
+            self.assertEqual(objects[13].values, [6.5] * 3)
+
+        def test_inline_light_records(self):
+            objects = list(ingest(record, StringIO(document(20)), chunk_size = 16, heavy = heavy_records(6)))
+            self.assertEqual([i.key for i in objects], range(20))
+
+        def test_backpressure(self):
+            stream = StringIO(document(200))
+            objects = ingest(record, stream, max_in_flight = 2, chunk_size = 64)
+            self.assertEqual(objects.next().key, 0)
+            self.assertTrue(stream.tell() < len(stream.getvalue()) / 10)
+            self.assertEqual([i.key for i in objects], range(1, 200))
+
+        def test_backpressure_within_chunk(self):
+            pool = ThreadPool(2)
+            submitted = []
+            class counting(object):
+                def apply_async(self, func, args, callback = None):
+                    submitted.append(None)
+                    return pool.apply_async(func, args, callback = callback)
+            try:
+                ingester = Ingester(record, counting(), max_in_flight = 4)
+                objects = ingester.feed(document(1000))
+                self.assertTrue(len(submitted) - len(objects) <= 4)
+                while ingester.pending():
+                    objects.append(ingester.wait())
+                    self.assertTrue(len(submitted) - len(objects) <= 4)
+                self.assertEqual([i.key for i in objects], range(1000))
+            finally:
+                pool.close()
+                pool.join()
+
+        def test_push(self):
+            ready = threading.Event()
+            ingester = Ingester(record, max_in_flight = 4, on_ready = ready.set)
+            data = document(30)
+            objects = []
+            try:
+                for i in xrange(0, len(data), 50):
+                    objects.extend(ingester.feed(data[i:i + 50]))
+                    self.assertTrue(len(ingester._in_flight) <= 4)
+                objects.extend(ingester.finish())
+                while ingester.pending():
+                    self.assertTrue(ready.wait(5))
+                    ready.clear()
+                    objects.extend(ingester.poll())
+            finally:
+                ingester.close()
+            self.assertEqual([i.key for i in objects], range(30))
+
+        def test_invalid_record(self):
+            data = '<records><record><key>1</key></record><record><key>a</key></record></records>'
+            objects = ingest(record, [data])
+            self.assertEqual(objects.next().key, 1)
+            self.assertRaises(ValueError, objects.next)
+            ingester = Ingester(record, heavy = heavy_records(100))
+            try:
+                self.assertEqual([i.key for i in ingester.feed(data)], [1])
+                self.assertRaises(ValueError, ingester.finish)
+            finally:
+                ingester.close()
+
+    unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(IngestTests))
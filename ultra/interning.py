@@ -0,0 +1,126 @@
+#/usr/bin/env python
+
+import sys
+
+class InternTable(object):
+
+    def __init__(self, maxsize = 65536):
+        self.maxsize = maxsize
+        self._current = {}
+        self._previous = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def __call__(self, val):
+        try:
+            key = (type(val), val)
+            rval = self._current.get(key)
+            if rval is None:
+                rval = self._previous.pop(key, None)
+                if rval is None:
+                    self.misses += 1
+                    rval = val
+                if len(self._current) * 2 >= self.maxsize:
+                    self.evictions += len(self._previous)
+                    self._previous = self._current
+                    self._current = {}
+                self._current[key] = rval
+        except TypeError:
+            return val
+        if rval is not val:
+            self.hits += 1
+            self.bytes_saved += sys.getsizeof(val)
+        return rval
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+    def stats(self):
+        return { 'size' : len(self), 'hits' : self.hits, 'misses' : self.misses,
+                 'evictions' : self.evictions, 'bytes_saved' : self.bytes_saved }
+
+    def __reduce__(self):
+        return (InternTable, (self.maxsize, ))
+
+if __name__ == '__main__':
+
+    import pickle
+    import unittest
+    from xml.etree import ElementTree
+    from magic import Object, Property
+    from type_definition import TypeDefinition, Specification
+    from xmlmixin import _xml
+    from utils import replace_none
+
+    codes = InternTable(1024)
+
+    class row(Object, _xml):
+        code = Property(Specification(str, intern = codes))
+        name = Property(str, intern = True)
+        tags = Property([Specification(str, intern = codes)])
+        scores = Property({Specification(str, intern = codes): float})
+
+        def __init__(self, code = '', name = '', tags = None, scores = None):
+            super(row, self).__init__()
+            self.code = code
+            self.name = name
+            self.tags = replace_none(tags, [])
+            self.scores = replace_none(scores, {})
+
+    def fresh(s):
+        return ''.join(list(s))
+
+    class InternTests(unittest.TestCase):
+
+        def test_table(self):
+            table = InternTable()
+            first = fresh('category')
+            self.assertTrue(table(first) is first)
+            self.assertTrue(table(fresh('category')) is first)
+            self.assertEqual(table(1.0), 1.0)
+            self.assertEqual(type(table(1)), int)
+            self.assertEqual(table([1]), [1])
+            self.assertEqual(table.stats()['hits'], 1)
+            self.assertEqual(table.stats()['misses'], 3)
+            self.assertEqual(table.stats()['bytes_saved'], sys.getsizeof(first))
+
+        def test_eviction(self):
+            table = InternTable(10)
+            for i in xrange(100):
+                table(fresh('value%d' % i))
+            self.assertTrue(len(table) <= 10)
+            self.assertTrue(table.stats()['evictions'] >= 80)
+            recent = table(fresh('value99'))
+            self.assertTrue(table(fresh('value99')) is recent)
+
+        def test_properties(self):
+            i = row(fresh('GB'), fresh('Smith'), [fresh('GB')], {fresh('GB'): 1.0})
+            j = row(fresh('GB'), fresh('Smith'))
+            self.assertTrue(j.code is i.code)
+            self.assertTrue(j.name is i.name)
+            self.assertTrue(i.tags[0] is i.code)
+            self.assertTrue(i.scores.keys()[0] is i.code)
+            j.tags.append(fresh('GB'))
+            j.scores.__setitem__(fresh('GB'), 2.0)
+            self.assertTrue(j.tags[0] is i.code)
+            self.assertTrue(j.scores.keys()[0] is i.code)
+
+        def test_from_xml(self):
+            rows = [row('FR', 'Martin', ['FR', 'EU'], {'FR': 0.5}) for k in xrange(10)]
+            loaded = [row.from_xml(ElementTree.fromstring(ElementTree.tostring(k.to_xml()))) for k in rows]
+            self.assertTrue(all(k.code is loaded[0].code for k in loaded))
+            self.assertTrue(all(k.tags[1] is loaded[0].tags[1] for k in loaded))
+            self.assertTrue(all(k.name is loaded[0].name for k in loaded))
+            self.assertTrue(codes.stats()['bytes_saved'] > 0)
+
+        def test_pickle(self):
+            table = pickle.loads(pickle.dumps(codes))
+            self.assertEqual((table.maxsize, len(table)), (1024, 0))
+
+    unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(InternTests))
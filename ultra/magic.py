@@ -1,9 +1,16 @@
 #/usr/bin/env python
 
 import type_definition
+import policies
+from collections import OrderedDict
+from concurrency import InstanceState
+from functools import partial
+from itertools import izip
 from types import FunctionType
 from utils import replace_none
 
+max_tracked_changes = 64
+
 import unittest
     
 class Descriptor(object):
@@ -57,27 +64,50 @@ class UltraProperty(OrderedClassAttribute):
 
 class Property(UltraProperty):
 
-    def __init__(self, prototype):
+    def __init__(self, prototype, **restrictions):
         super(Property, self).__init__()
-        self._type_definition = type_definition.TypeDefinition(prototype)
+        self._type_definition = type_definition.TypeDefinition(prototype, **restrictions)
         
     def create_read_method(self, attr):
-        return lambda instance: instance.__dict__[attr]
+        def read(instance):
+            try:
+                return instance.__dict__[attr]
+            except KeyError:
+                return _materialize(instance, attr, self._type_definition)
+        return read
 
     def create_write_method(self, attr):
-        def writer(instance, val):
-            if self._type_definition.type_match(val):
+        def write(instance, val, lock = None):
+            if instance.__ultra_frozen__:
+                if getattr(instance, '__ultra_sealed__', False):
+                    raise TypeError('%s is frozen' % type(instance).__name__)
+                instance.__dict__[attr] = self._type_definition.freeze(val)
+            elif val is instance.__dict__.get(attr) and isinstance(val, type_definition.WithMixin):
+                return
+            elif policies.resolve(self._type_definition, instance.__ultra_validation__).type_match(
+                    self._type_definition, val):
                 instance.__dict__[attr] = self._type_definition.proxy(val, 
-                    instance.__ultra_do_invariant_checks__)
+                    instance.__ultra_do_invariant_checks__, trusted = True, lock = lock,
+                    tracker = partial(_track, instance, attr), policy = instance.__ultra_validation__)
             else:
                 raise TypeError('%s is type %s not %s' % (val, type(val), self._type_definition))
+            instance.__ultra_dirty__[attr] = None
+            _forget_source(instance, attr)
             instance.__ultra_do_invariant_checks__()
+
+        def writer(instance, val):
+            if instance.__ultra_concurrent__:
+                lock = instance.__ultra_state__.lock
+                with lock:
+                    write(instance, val, lock)
+            else:
+                write(instance, val)
         return writer
         
 class Identity(Property):
 
-    def __init__(self, prototype):
-        super(Identity, self).__init__(prototype)
+    def __init__(self, prototype, **restrictions):
+        super(Identity, self).__init__(prototype, **restrictions)
         
     def create_eq(self, attr):
         def eq(self, other):
@@ -91,16 +121,76 @@ class Identity(Property):
         
     def create_hash(self, attr):
         def hash(self):
-            return self.attr.__hash__()
+            return getattr(self, attr).__hash__()
         return hash
 
+def _track(instance, attr, proxy, change):
+    if instance.__dict__.get(attr) is not proxy:
+        return
+    _forget_source(instance, attr)
+    dirty = instance.__ultra_dirty__
+    if change[0] in ('set', 'delete'):
+        changes = dirty.get(attr, OrderedDict())
+        if changes is None:
+            return
+        changes[change[1]] = change
+    else:
+        changes = dirty.get(attr, [])
+        if changes is None:
+            return
+        merged = _merge(changes[-1], change) if changes else None
+        if merged is None:
+            changes.append(change)
+        else:
+            changes[-1] = merged
+    dirty[attr] = changes if len(changes) <= max_tracked_changes else None
+
+def _merge(last, change):
+    if last[0] == 'append' and change[0] == 'append' and last[2] == change[1]:
+        return ('append', last[1], change[2])
+    if last[0] == 'setslice' and change[0] == 'setslice':
+        tag, i1, j1, n1 = last
+        tag, i2, j2, n2 = change
+        if i2 <= i1 + n1 and j2 >= i1:
+            return ('setslice', min(i1, i2), max(j1, j2 - n1 + j1 - i1),
+                max(i1 + n1, j2) - min(i1, i2) - (j2 - i2) + n2)
+    return None
+
+def _forget_source(instance, attr):
+    lazy = instance.__dict__.get('__ultra_lazy__')
+    if lazy:
+        lazy.pop(attr, None)
+
+def _materialize(instance, attr, type_description):
+    lazy = instance.__dict__.get('__ultra_lazy__')
+    if lazy is None or attr not in lazy:
+        raise KeyError(attr)
+    if instance.__ultra_concurrent__:
+        lock = instance.__ultra_state__.lock
+        with lock:
+            return _load(instance, attr, type_description, lazy, lock)
+    return _load(instance, attr, type_description, lazy)
+
+def _load(instance, attr, type_description, lazy, lock = None):
+    if attr in instance.__dict__:
+        return instance.__dict__[attr]
+    val = lazy[attr][1]()
+    if not policies.resolve(type_description, instance.__ultra_validation__).type_match(type_description, val):
+        raise TypeError('%s is type %s not %s' % (val, type(val), type_description))
+    instance.__dict__[attr] = type_description.proxy(val, instance.__ultra_do_invariant_checks__,
+        trusted = True, lock = lock, tracker = partial(_track, instance, attr),
+        policy = instance.__ultra_validation__)
+    return instance.__dict__[attr]
+
 def Invariant(boolean_op):
     boolean_op.__is_an_invariant__ = True
     return boolean_op
     
 def InvariantChecked(method):
     def invariants_checked(*args, **kwargs):
-        if isinstance(args[0], Object):
+        if isinstance(args[0], Object) and args[0].__ultra_concurrent__:
+            return args[0].__ultra_state__.checked_call(args[0], method, args, kwargs)
+        elif isinstance(args[0], Object):
             try:
                 args[0].__ultra_invariant_checks__ = False
                 t = method(*args, **kwargs)
@@ -124,6 +214,38 @@ class DerivedProperty(UltraProperty):
 def Derived(func):
     return DerivedProperty(func)
 
+def FrozenKey(attr):
+    if attr is not None:
+        return lambda instance: getattr(instance, attr)
+    return lambda instance: tuple(instance.__dict__.get(property_name)
+        for property_name, type_description in type(instance)._sorted_properties())
+
+def FrozenHash(key):
+    def frozen_hash(self):
+        try:
+            return self.__dict__['__ultra_hash__']
+        except KeyError:
+            rval = hash(key(self))
+            if getattr(self, '__ultra_sealed__', False):
+                self.__dict__['__ultra_hash__'] = rval
+            return rval
+    return frozen_hash
+
+def FrozenEq(key):
+    def frozen_eq(self, other):
+        if self is other:
+            return True
+        if type(self) is not type(other) or hash(self) != hash(other):
+            return False
+        return key(self) == key(other)
+    return frozen_eq
+
+def FrozenNe(key):
+    eq = FrozenEq(key)
+    def frozen_ne(self, other):
+        return not eq(self, other)
+    return frozen_ne
+
 class Meta(type):
 
     def __new__(cls, name, bases, dict):
@@ -163,28 +285,187 @@ class Meta(type):
             dict['__ne__'] = v.create_ne(k)
             dict['__hash__'] = v.create_hash(k)
             
+        if dict.get('__ultra_frozen__', any(getattr(b, '__ultra_frozen__', False) for b in bases)):
+            key = FrozenKey(id[1] if id is not None else None)
+            dict['__eq__'] = FrozenEq(key)
+            dict['__ne__'] = FrozenNe(key)
+            dict['__hash__'] = FrozenHash(key)
+            
         dict['__ultra_invariants__'] = invariants
         
         t = super(Meta, cls).__new__(cls, name, bases, dict)
         return t
 
+    def __call__(cls, *args, **kwargs):
+        instance = super(Meta, cls).__call__(*args, **kwargs)
+        if cls.__ultra_frozen__:
+            instance.__ultra_sealed__ = True
+        return instance
+
 class Object(object):
     __metaclass__ = Meta
+    __ultra_concurrent__ = False
+    __ultra_frozen__ = False
+    __ultra_validation__ = None
+
+    def __new__(cls, *args, **kwargs):
+        instance = super(Object, cls).__new__(cls)
+        instance.__ultra_dirty__ = {}
+        if cls.__ultra_concurrent__:
+            instance.__ultra_state__ = InstanceState()
+        return instance
     
     def __ultra_do_invariant_checks__(self):
+        if self.__ultra_concurrent__ and self.__ultra_state__.deferred():
+            return
         if getattr(self, '__ultra_invariant_checks__', False):
             for invariant in self.__class__.__ultra_invariants__:
                 if not invariant(self):
                     raise ValueError('Invariant has been violated')
     
+    def changed_properties(self):
+        return [property_name for property_name, type_description in type(self)._sorted_properties()
+            if property_name in self.__ultra_dirty__]
+
+    def changes(self):
+        rval = {}
+        for property_name, changes in self.__ultra_dirty__.items():
+            if isinstance(changes, OrderedDict):
+                changes = changes.values()
+            elif changes is not None:
+                changes = list(changes)
+            rval[property_name] = changes
+        return rval
+
+    def mark_clean(self):
+        self.__ultra_dirty__.clear()
+
+    def clone(self, deep = True):
+        cls = type(self)
+        if cls.__ultra_frozen__:
+            return self
+        if cls.__ultra_concurrent__:
+            with self.__ultra_state__.lock:
+                return self._clone(deep)
+        return self._clone(deep)
+
+    def _clone(self, deep):
+        cls = type(self)
+        rval = cls.__new__(cls)
+        do_invariant_checks = rval.__ultra_do_invariant_checks__
+        lock = rval.__ultra_state__.lock if cls.__ultra_concurrent__ else None
+        for property_name, type_description in cls._sorted_properties():
+            if property_name in self.__dict__:
+                rval.__dict__[property_name] = type_description.proxy(
+                    type_description.clone_contents(self.__dict__[property_name], deep), do_invariant_checks,
+                    trusted = True, lock = lock, tracker = partial(_track, rval, property_name),
+                    policy = cls.__ultra_validation__)
+        rval.__ultra_dirty__.update((k, v if v is None else type(v)(v)) for k, v in self.__ultra_dirty__.items())
+        if '__ultra_invariant_checks__' in self.__dict__:
+            rval.__ultra_invariant_checks__ = self.__ultra_invariant_checks__
+        if self.__dict__.get('__ultra_lazy__'):
+            rval.__ultra_lazy__ = dict(self.__ultra_lazy__)
+        return rval
+
+    def evolve(self, **changes):
+        cls = type(self)
+        if not cls.__ultra_frozen__:
+            raise TypeError('%s is not frozen' % cls.__name__)
+        rval = cls.__new__(cls)
+        rval.__ultra_dirty__.update(self.__ultra_dirty__)
+        for property_name, type_description in cls._sorted_properties():
+            if property_name in changes:
+                rval.__dict__[property_name] = type_description.freeze(changes.pop(property_name))
+                rval.__ultra_dirty__[property_name] = None
+            elif property_name in self.__dict__:
+                rval.__dict__[property_name] = self.__dict__[property_name]
+        if changes:
+            raise AttributeError('%s has no property %s' % (cls.__name__, ', '.join(sorted(changes))))
+        if cls.__ultra_invariants__:
+            rval.__ultra_invariant_checks__ = True
+        rval.__ultra_do_invariant_checks__()
+        rval.__ultra_sealed__ = True
+        return rval
+
+    def __reduce__(self):
+        return (_reconstruct, (type(self), ) + tuple(self._stored_value(property_name, type_description)
+            for property_name, type_description in type(self)._stored_properties()))
+
+    def _stored_value(self, property_name, type_description):
+        try:
+            return type_description.unproxy(getattr(self, property_name))
+        except KeyError:
+            return _Unset
+
     @classmethod
     def _sorted_properties(cls):
-        properties = cls.__ultra__.items()
-        properties.sort(key=lambda x: x[1][0])
-        return [(i[0], i[1][1]) for i in properties]
+        if '__ultra_sorted__' not in cls.__dict__:
+            properties = cls.__ultra__.items()
+            properties.sort(key=lambda x: x[1][0])
+            cls.__ultra_sorted__ = [(i[0], i[1][1]) for i in properties]
+        return cls.__ultra_sorted__
+
+    @classmethod
+    def _stored_properties(cls):
+        if '__ultra_stored__' not in cls.__dict__:
+            cls.__ultra_stored__ = [(property_name, type_description)
+                for property_name, type_description in cls._sorted_properties()
+                if getattr(cls, property_name)._writer is not None]
+        return cls.__ultra_stored__
+
+class _Unset(object):
+    pass
+
+def _reconstruct(cls, *values):
+    instance = cls.__new__(cls)
+    do_invariant_checks = instance.__ultra_do_invariant_checks__
+    lock = instance.__ultra_state__.lock if cls.__ultra_concurrent__ else None
+    for (property_name, type_description), val in izip(cls._stored_properties(), values):
+        if val is _Unset:
+            continue
+        if cls.__ultra_frozen__:
+            instance.__dict__[property_name] = type_description._freeze(val)
+        else:
+            instance.__dict__[property_name] = type_description.proxy(val, do_invariant_checks,
+                trusted = True, lock = lock, tracker = partial(_track, instance, property_name),
+                policy = cls.__ultra_validation__)
+    if cls.__ultra_invariants__:
+        instance.__ultra_invariant_checks__ = True
+    if cls.__ultra_frozen__:
+        instance.__ultra_sealed__ = True
+    return instance
                 
 if __name__ == '__main__':
 
+    import pickle
+
+    class pickled(Object):
+        a = Property(int)
+        b = Property([str])
+        c = Property({int: (int, str)})
+
+        def __init__(self, a = 0, b = None, c = None):
+            super(pickled, self).__init__()
+            self.a = a
+            self.b = replace_none(b, [])
+            self.c = replace_none(c, {})
+
+        @Invariant
+        def verify(self):
+            return len(self.b) <= self.a
+
+    class partial_pickled(Object):
+        a = Property(int)
+        b = Property([str])
+
+        def __init__(self, a = 0):
+            super(partial_pickled, self).__init__()
+            self.a = a
+
+        @Derived
+        def size(self):
+            return len(self.b)
+
     class MagicTests(unittest.TestCase):
     
         def test_property(self):
@@ -306,6 +587,66 @@ if __name__ == '__main__':
             self.assertEqual(i.a, [[1, 2], [3, 4]])
             self.assertRaises(TypeError, i.a.append, 4)
             self.assertRaises(TypeError, i.a.append, ['a', 'b'])
+            self.assertRaises(TypeError, i.a[0].append, 'a')
+            self.assertRaises(TypeError, i.a[1].__setitem__, 0, 'a')
+            i.a[1].append(5)
+            self.assertEqual(i.a, [[1, 2], [3, 4, 5]])
+            self.assertTrue(all(isinstance(k, type_definition.ListProxy) for k in i.a))
+            self.assertEqual(i.a[0:1], [[1, 2]])
+            self.assertEqual(i.a[-1:], [[3, 4, 5]])
+            i.a[-1:][0].append(6)
+            self.assertEqual(i.a, [[1, 2], [3, 4, 5, 6]])
+
+        def test_nested(self):
+
+            class u(Object):
+                a = Property([[int]])
+                b = Property({str: {int: [str]}})
+                c = Property([int])
+
+                def __init__(self):
+                    super(u, self).__init__()
+                    self.a = [[1], [2]]
+                    self.b = {'x': {1: ['one']}}
+                    self.c = []
+
+                @Invariant
+                def verify(self):
+                    return sum(len(k) for k in self.a) < 6
+
+            i = u()
+            i.mark_clean()
+            i.a[1][0] = 3
+            i.b['x'][1].append('uno')
+            self.assertEqual(i.changes(), {'a': [('setslice', 1, 2, 1)], 'b': [('set', 'x')]})
+            self.assertRaises(TypeError, i.b['x'][1].append, 1)
+            self.assertRaises(TypeError, i.b['x'].__setitem__, 'y', [])
+            self.assertEqual(i.b.items()[0][1].items()[0][1], ['one', 'uno'])
+            i.mark_clean()
+            i.a.insert(0, [])
+            i.a[2].append(4)
+            self.assertEqual(i.changes(), {'a': [('setslice', 0, 0, 1), ('setslice', 2, 3, 1)]})
+            self.assertRaises(ValueError, i.a[0].extend, [1, 2, 3])
+            inner = i.a[1]
+            del i.a[1]
+            i.mark_clean()
+            inner.append(5)
+            self.assertEqual(i.changes(), {})
+
+            data = type_definition.ListProxy([1, 2])
+            i.c = data
+            self.assertTrue(i.c is data)
+            j = u()
+            j.c = i.c
+            self.assertFalse(j.c is i.c)
+            j.a = i.a
+            j.a[0].pop()
+            self.assertEqual((i.a[0], j.a[0]), ([1, 2, 3], [1, 2]))
+
+            k = u()
+            k.__reduce__()
+            k.clone()
+            self.assertEqual(type(dict.__getitem__(dict.__getitem__(k.b, 'x'), 1)), list)
             
         def test_invariant(self):
             
@@ -390,6 +731,205 @@ if __name__ == '__main__':
             self.assertEqual(i.a, 'foo')
             self.assertEqual(i.b, 5)
             self.assertRaises(TypeError, setattr, i, 'a', 3)
+
+        def test_changes(self):
+            i = pickled(2, ['one'], {})
+            self.assertEqual(i.changed_properties(), ['a', 'b', 'c'])
+            self.assertEqual(i.changes(), {'a': None, 'b': None, 'c': None})
+            i.mark_clean()
+            self.assertEqual(i.changes(), {})
+            i.b.append('two')
+            self.assertRaises(ValueError, i.b.append, 'three')
+            i.a = 10
+            i.b.append('four')
+            i.b.__setslice__(0, 1, ['zero', 'half'])
+            i.c.__setitem__(1, (1, 'one'))
+            i.c.__setitem__(2, (2, 'two'))
+            i.c.__setitem__(1, (1, 'uno'))
+            self.assertEqual(i.changed_properties(), ['a', 'b', 'c'])
+            self.assertEqual(i.changes(), {'a': None,
+                'b': [('append', 1, 4), ('setslice', 0, 1, 2)],
+                'c': [('set', 1), ('set', 2)]})
+            b = i.b
+            i.b = []
+            i.mark_clean()
+            b.append('detached')
+            self.assertEqual(i.changes(), {})
+            i.b.append('one')
+            i.b = ['two']
+            self.assertEqual(i.changes(), {'b': None})
+            i.mark_clean()
+            i.c[3] = (3, 'three')
+            i.c[4] = (4, 'four')
+            del i.c[3]
+            i.b[0] = 'one'
+            self.assertEqual(i.changes(), {'b': [('setslice', 0, 1, 1)], 'c': [('delete', 3), ('set', 4)]})
+            self.assertRaises(TypeError, i.c.__setitem__, 5, 5)
+            self.assertRaises(ValueError, i.b.extend, ['x'] * 10)
+            i.b = ['p', 'q']
+            i.mark_clean()
+            for k in xrange(1000):
+                i.b[0] = str(k)
+                i.c[5] = (k, 'five')
+            del i.b[0]
+            del i.b[0]
+            self.assertEqual(i.changes(), {'b': [('setslice', 0, 2, 0)], 'c': [('set', 5)]})
+            self.assertEqual(len(i.__ultra_dirty__['c']), 1)
+            i.mark_clean()
+            i.b.insert(0, 'a')
+            i.b.insert(0, 'b')
+            i.b[1] = 'c'
+            self.assertEqual(i.changes(), {'b': [('setslice', 0, 0, 2)]})
+            i.mark_clean()
+            for k in xrange(max_tracked_changes + 1):
+                i.c[k + 10] = (k, 'many')
+            self.assertEqual(i.changes(), {'c': None})
+            i.mark_clean()
+            b = i.b
+            i.b += ['d']
+            self.assertTrue(i.b is b)
+            self.assertEqual(i.changes(), {'b': [('append', 2, 3)]})
+
+        def test_frozen(self):
+
+            class u(Object):
+                __ultra_frozen__ = True
+
+                a = Property(int)
+                b = Property([[int]])
+                c = Property({(int, int): str})
+
+                def __init__(self, a = 0, b = None, c = None):
+                    super(u, self).__init__()
+                    self.a = a
+                    self.b = replace_none(b, [])
+                    self.c = replace_none(c, {})
+
+                @Invariant
+                def verify(self):
+                    return len(self.b) >= self.a
+
+            i = u(1, [[1, 2], [3]], {(0, 0): 'origin'})
+            self.assertEqual(i.b, [[1, 2], [3]])
+            self.assertEqual(i.c[(0, 0)], 'origin')
+            self.assertRaises(TypeError, setattr, i, 'a', 2)
+            self.assertEqual(i.b.append([4]), [[1, 2], [3], [4]])
+            self.assertEqual(i.b, [[1, 2], [3]])
+            self.assertRaises(TypeError, u, 0, [[1]], {(0, 'x'): 'bad'})
+
+            j = i.evolve(b = i.b.set(1, i.b[1].append(4)), c = i.c.set((1, 1), 'one'))
+            self.assertEqual(j.b, [[1, 2], [3, 4]])
+            self.assertEqual(i.b, [[1, 2], [3]])
+            self.assertTrue(j.b[0] is i.b[0])
+            self.assertEqual(j.c, {(0, 0): 'origin', (1, 1): 'one'})
+            self.assertEqual(j.changed_properties(), ['a', 'b', 'c'])
+            self.assertRaises(TypeError, i.b.append, ['x'])
+            self.assertRaises(TypeError, i.c.set, (1, 'x'), 'x')
+            self.assertRaises(TypeError, i.evolve, b = [['x']])
+            self.assertRaises(ValueError, i.evolve, a = 5)
+            self.assertRaises(AttributeError, i.evolve, d = 5)
+            self.assertRaises(TypeError, pickled().evolve, a = 1)
+
+            self.assertEqual(i, u(1, [[1, 2], [3]], {(0, 0): 'origin'}))
+            self.assertNotEqual(i, j)
+            self.assertEqual(hash(i), hash(u(1, [[1, 2], [3]], {(0, 0): 'origin'})))
+            self.assertEqual(i.__dict__['__ultra_hash__'], hash(i))
+            self.assertEqual(len(set([i, j, i.evolve()])), 2)
+
+        def test_frozen_identity(self):
+
+            class u(Object):
+                __ultra_frozen__ = True
+
+                a = Identity(str)
+                b = Property([int])
+
+                def __init__(self, a = '', b = None):
+                    super(u, self).__init__()
+                    self.a = a
+                    self.b = replace_none(b, [])
+
+            i = u('one', [1])
+            self.assertEqual(i, i.evolve(b = [2]))
+            self.assertNotEqual(i, i.evolve(a = 'two'))
+            self.assertEqual(hash(i), hash('one'))
+
+        def test_clone(self):
+
+            class v(Object):
+                a = Property(int)
+
+                def __init__(self, a = 0):
+                    super(v, self).__init__()
+                    self.a = a
+
+            class u(Object):
+                a = Property([v])
+                b = Property({str: [int]})
+                c = Property((int, str))
+                d = Property(v)
+
+                def __init__(self):
+                    super(u, self).__init__()
+                    self.a = [v(1), v(2)]
+                    self.b = {'x': [1, 2]}
+                    self.c = (1, 'one')
+                    self.d = v(3)
+
+                @Invariant
+                def verify(self):
+                    return len(self.a) < 3
+
+            i = u()
+            i.mark_clean()
+            j = i.clone()
+            self.assertEqual([k.a for k in j.a], [1, 2])
+            self.assertEqual((j.b, j.c, j.d.a), ({'x': [1, 2]}, (1, 'one'), 3))
+            self.assertFalse(j.a[0] is i.a[0] or j.d is i.d or j.b['x'] is i.b['x'])
+            self.assertRaises(TypeError, j.a.append, 4)
+            self.assertRaises(ValueError, j.a.append, v(4))
+            self.assertEqual(len(i.a), 2)
+            j.d.a = 5
+            self.assertEqual(i.d.a, 3)
+            self.assertEqual(j.changes(), {'a': [('append', 2, 3)]})
+
+            k = i.clone(deep = False)
+            self.assertTrue(k.a[0] is i.a[0] and k.d is i.d and k.b['x'] == i.b['x'])
+            self.assertFalse(k.a is i.a)
+            k.b.__setitem__('y', [])
+            self.assertEqual(i.b, {'x': [1, 2]})
+
+        def test_pickle(self):
+            i = pickled(2, ['one', 'two'], {1: (1, 'one')})
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                j = pickle.loads(pickle.dumps(i, protocol))
+                self.assertEqual(type(j), pickled)
+                self.assertEqual(j.a, 2)
+                self.assertEqual(j.b, ['one', 'two'])
+                self.assertEqual(j.c, {1: (1, 'one')})
+                self.assertRaises(TypeError, j.b.append, 3)
+                self.assertRaises(TypeError, j.c.__setitem__, 2, 'two')
+                self.assertRaises(ValueError, j.b.append, 'three')
+                self.assertRaises(ValueError, setattr, j, 'a', 1)
+                self.assertEqual(j.changed_properties(), ['a', 'b'])
+
+        def test_pickle_derived(self):
+            i = partial_pickled(2)
+            self.assertEqual(len(i.__reduce__()[1]), 3)
+            j = pickle.loads(pickle.dumps(i, 2))
+            self.assertEqual(j.a, 2)
+            self.assertFalse('b' in j.__dict__)
+            j.b = ['one']
+            self.assertEqual(j.size, 1)
+            k = pickle.loads(pickle.dumps(j))
+            self.assertEqual((k.a, k.b, k.size), (2, ['one'], 1))
+
+        def test_pickle_size(self):
+            i = pickled(3, ['one', 'two', 'three'], {1: (1, 'one'), 2: (2, 'two')})
+            values = (3, ['one', 'two', 'three'], {1: (1, 'one'), 2: (2, 'two')})
+            objects = pickle.dumps([i] * 1 + [pickled(3, list(values[1]), dict(values[2])) for _ in range(99)], 2)
+            plain = pickle.dumps([values] * 1 + [(3, list(values[1]), dict(values[2])) for _ in range(99)], 2)
+            self.assertTrue(len(objects) - len(plain) < 16 * 100)
     
     unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(MagicTests))
     
\ No newline at end of file
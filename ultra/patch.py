@@ -0,0 +1,348 @@
+#/usr/bin/env python
+
+from difflib import SequenceMatcher
+from magic import Object
+from type_definition import sequence_name, mapping_name, raw_values, raw_items
+
+def _key(type_description, val):
+    return type_description.subhandler(val,
+        leaf = _leaf_key,
+        tuple = lambda type_description, val, **kwargs: tuple(
+            _key(i, v) for i, v in zip(type_description._tuple_contents, val)),
+        sequence = lambda type_description, val, **kwargs: tuple(
+            _key(type_description._contents, v) for v in raw_values(val)),
+        mapping = lambda type_description, val, **kwargs: frozenset(
+            (_key(type_description._key_contents, k), _key(type_description._value_contents, v))
+            for k, v in raw_items(val)))
+
+def _leaf_key(type_description, val, **kwargs):
+    if isinstance(val, Object):
+        return (type(val), tuple(_key(i, getattr(val, property_name))
+            for property_name, i in type(val)._stored_properties()))
+    return val
+
+def _nested(old, new):
+    return isinstance(old, Object) and type(old) is type(new)
+
+def _diff_value(type_description, old, new):
+    if old is new:
+        return None
+    if _nested(old, new):
+        subpatch = diff(old, new)
+        return ('object', subpatch) if subpatch else None
+    if _key(type_description, old) == _key(type_description, new):
+        return None
+    return type_description.subhandler(old, new,
+        leaf = lambda type_description, old, new, **kwargs: ('set', new),
+        tuple = lambda type_description, old, new, **kwargs: ('set', new),
+        sequence = _diff_sequence,
+        mapping = _diff_mapping)
+
+def _diff_sequence(type_description, old, new, **kwargs):
+    contents = type_description._contents
+    old, new = list(raw_values(old)), list(raw_values(new))
+    old_keys = [_key(contents, i) for i in old]
+    new_keys = [_key(contents, i) for i in new]
+    edits = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_keys, new_keys, False).get_opcodes():
+        if tag == 'equal':
+            continue
+        if tag == 'replace' and i2 - i1 == j2 - j1 and all(_nested(old[i1 + k], new[j1 + k])
+                for k in xrange(i2 - i1)):
+            for k in xrange(i2 - i1):
+                edits.append(('object', i1 + k, diff(old[i1 + k], new[j1 + k])))
+        else:
+            edits.append(('splice', i1, i2, list(new[j1:j2])))
+    return ('sequence', tuple(edits))
+
+def _diff_mapping(type_description, old, new, **kwargs):
+    old, new = dict(raw_items(old)), dict(raw_items(new))
+    removed = tuple(k for k in old if k not in new)
+    changed = []
+    nested = []
+    for k, v in new.items():
+        if k not in old:
+            changed.append((k, v))
+            continue
+        op = _diff_value(type_description._value_contents, old[k], v)
+        if op is None:
+            continue
+        elif op[0] == 'object':
+            nested.append((k, op[1]))
+        else:
+            changed.append((k, v))
+    return ('mapping', removed, tuple(changed), tuple(nested))
+
+def diff(a, b):
+    if type(a) is not type(b):
+        raise TypeError('%s and %s are not the same type' % (type(a), type(b)))
+    rval = []
+    for property_name, type_description in type(a)._stored_properties():
+        op = _diff_value(type_description, getattr(a, property_name), getattr(b, property_name))
+        if op is not None:
+            rval.append((property_name, op))
+    return tuple(rval)
+
+def _apply_value(type_description, val, op):
+    if op[0] == 'set':
+        return op[1]
+    elif op[0] == 'object' and isinstance(val, Object):
+        return apply(val, op[1])
+    elif op[0] == 'sequence' and type_description._category == sequence_name:
+        return _apply_sequence(val, op[1])
+    elif op[0] == 'mapping' and type_description._category == mapping_name:
+        return _apply_mapping(val, op[1], op[2], op[3])
+    raise ValueError('%r cannot be applied to a %s' % (op[0], type_description))
+
+def _apply_sequence(val, edits):
+    rval = list(val)
+    last = len(rval)
+    for edit in reversed(edits):
+        if edit[0] == 'splice':
+            tag, i1, i2, values = edit
+            if not 0 <= i1 <= i2 <= last:
+                raise ValueError('Splice %d:%d is out of range' % (i1, i2))
+            rval[i1:i2] = values
+            last = i1
+        elif edit[0] == 'object':
+            tag, i, subpatch = edit
+            if not 0 <= i < last or not isinstance(rval[i], Object):
+                raise ValueError('No object at %d' % i)
+            apply(rval[i], subpatch)
+            last = i
+        else:
+            raise ValueError('Unknown sequence edit %r' % (edit[0], ))
+    return rval
+
+def _apply_mapping(val, removed, changed, nested):
+    rval = dict(val)
+    for k in removed:
+        if k not in rval:
+            raise ValueError('%r is not in the mapping' % (k, ))
+        del rval[k]
+    for k, v in changed:
+        rval[k] = v
+    for k, subpatch in nested:
+        if not isinstance(rval.get(k), Object):
+            raise ValueError('No object at %r' % (k, ))
+        apply(rval[k], subpatch)
+    return rval
+
+def _suspend(obj):
+    previous = obj.__dict__.get('__ultra_invariant_checks__', False)
+    obj.__ultra_invariant_checks__ = False
+    return previous
+
+def _resume(obj, previous):
+    obj.__ultra_invariant_checks__ = previous
+    obj.__ultra_do_invariant_checks__()
+
+def apply(obj, patch):
+    cls = type(obj)
+    if cls.__ultra_frozen__:
+        raise TypeError('%s is frozen' % cls.__name__)
+    if cls.__ultra_concurrent__:
+        state = obj.__ultra_state__
+        with state.lock:
+            staged = _stage(obj, patch)
+            state.checked_call(obj, _commit, (obj, staged, patch), {})
+    else:
+        staged = _stage(obj, patch)
+        previous = _suspend(obj)
+        _commit(obj, staged, patch)
+        _resume(obj, previous)
+    return obj
+
+def _stage(obj, patch):
+    cls = type(obj)
+    stored = dict(cls._stored_properties())
+    staged = obj.clone()
+    previous = _suspend(staged)
+    for property_name, op in patch:
+        if property_name not in stored:
+            raise ValueError('%s has no property %s' % (cls.__name__, property_name))
+        type_description = stored[property_name]
+        val = _apply_value(type_description, getattr(staged, property_name), op)
+        if not type_description.type_match(val):
+            raise TypeError('%s is type %s not %s' % (val, type(val), type_description))
+        setattr(staged, property_name, val)
+    _resume(staged, previous)
+    return staged
+
+def _commit(obj, staged, patch):
+    for property_name, op in patch:
+        setattr(obj, property_name, getattr(staged, property_name))
+
+if __name__ == '__main__':
+
+    import pickle
+    import unittest
+    from magic import Property, Invariant, Derived
+    from type_definition import TypeDefinition
+    from utils import replace_none
+
+    class point(Object):
+        x = Property(int)
+        y = Property(int)
+
+        def __init__(self, x = 0, y = 0):
+            super(point, self).__init__()
+            self.x = x
+            self.y = y
+
+    class shape(Object):
+        name = Property(str)
+        origin = Property(point)
+        vertices = Property([point])
+        labels = Property({int: str})
+        anchors = Property({str: point})
+        size = Property((int, int))
+        tags = Property([str])
+
+        def __init__(self, name = '', origin = None, vertices = None, labels = None, anchors = None,
+                size = (0, 0), tags = None):
+            super(shape, self).__init__()
+            self.name = name
+            self.origin = replace_none(origin, point())
+            self.vertices = replace_none(vertices, [])
+            self.labels = replace_none(labels, {})
+            self.anchors = replace_none(anchors, {})
+            self.size = size
+            self.tags = replace_none(tags, [])
+
+        @Invariant
+        def sized(self):
+            return self.size[0] >= 0 and self.size[1] >= 0
+
+    def square():
+        return shape('square', point(1, 1), [point(0, 0), point(0, 1), point(1, 1), point(1, 0)],
+            {1: 'one', 2: 'two'}, {'centre': point(1, 1)}, (2, 2), ['a', 'b', 'c', 'd'])
+
+    def same(a, b):
+        return _key(TypeDefinition(shape), a) == _key(TypeDefinition(shape), b)
+
+    class PatchTests(unittest.TestCase):
+
+        def test_identical(self):
+            self.assertEqual(diff(square(), square()), ())
+
+        def test_leaf(self):
+            a, b = square(), square()
+            b.name = 'box'
+            self.assertEqual(diff(a, b), (('name', ('set', 'box')), ))
+
+        def test_nested(self):
+            a, b = square(), square()
+            b.origin.y = 3
+            self.assertEqual(diff(a, b), (('origin', ('object', (('y', ('set', 3)), ))), ))
+            self.assertTrue(same(apply(a, diff(a, b)), b))
+
+        def test_sequence(self):
+            a, b = square(), square()
+            b.tags = ['a', 'x', 'c', 'd', 'e']
+            b.vertices = [point(0, 0), point(0, 2), point(1, 1)]
+            patch = diff(a, b)
+            self.assertEqual(dict(patch)['tags'], ('sequence', (('splice', 1, 2, ['x']), ('splice', 4, 4, ['e']))))
+            self.assertTrue(same(apply(a, patch), b))
+
+        def test_mapping(self):
+            a, b = square(), square()
+            b.labels = {2: 'deux', 3: 'three'}
+            b.anchors['centre'].x = 5
+            b.anchors.__setitem__('corner', point(2, 2))
+            patch = diff(a, b)
+            removed, changed, nested = dict(patch)['labels'][1:]
+            self.assertEqual((removed, sorted(changed), nested), ((1, ), [(2, 'deux'), (3, 'three')], ()))
+            self.assertTrue(same(apply(a, patch), b))
+
+        def test_nested_containers(self):
+
+            class grid(Object):
+                rows = Property([[int]])
+
+                def __init__(self, rows = None):
+                    super(grid, self).__init__()
+                    self.rows = replace_none(rows, [])
+
+            a, b = grid([[1], [2]]), grid([[1], [2, 3]])
+            self.assertEqual(diff(a, b), (('rows', ('sequence', (('splice', 1, 2, [[2, 3]]), ))), ))
+            self.assertEqual(type(list.__getitem__(b.rows, 1)), list)
+            self.assertEqual(apply(a, diff(a, b)).rows, [[1], [2, 3]])
+
+        def test_derived(self):
+
+            class words(Object):
+                b = Property([str])
+
+                def __init__(self, b = None):
+                    super(words, self).__init__()
+                    self.b = replace_none(b, [])
+
+                @Derived
+                def n(self):
+                    return len(self.b)
+
+            a, b = words(['x']), words(['x', 'y'])
+            patch = diff(a, b)
+            self.assertEqual(patch, (('b', ('sequence', (('splice', 1, 1, ['y']), ))), ))
+            self.assertEqual(apply(a, patch).n, 2)
+            self.assertRaises(ValueError, apply, a, (('n', ('set', 3)), ))
+
+        def test_serializable(self):
+            a, b = square(), square()
+            b.vertices[2].x = 4
+            b.tags = []
+            patch = pickle.loads(pickle.dumps(diff(a, b), 2))
+            self.assertTrue(same(apply(a, patch), b))
+
+        def test_corrupt(self):
+            a = square()
+            self.assertRaises(TypeError, apply, a, (('name', ('set', 3)), ))
+            self.assertRaises(TypeError, apply, a, (('tags', ('sequence', (('splice', 0, 1, [1]), ))), ))
+            self.assertRaises(ValueError, apply, a, (('tags', ('sequence', (('splice', 3, 9, []), ))), ))
+            self.assertRaises(ValueError, apply, a, (('labels', ('mapping', (7, ), (), ())), ))
+            self.assertRaises(ValueError, apply, a, (('missing', ('set', 3)), ))
+            self.assertRaises(ValueError, apply, a, (('name', ('sequence', ())), ))
+            self.assertRaises(ValueError, apply, a, (('size', ('set', (-1, 2))), ))
+            self.assertEqual(a.tags, ['a', 'b', 'c', 'd'])
+
+        def test_atomic(self):
+            a = square()
+            self.assertRaises(TypeError, apply, a, (('origin', ('object', (('y', ('set', 3)), ))),
+                ('name', ('set', 3))))
+            self.assertEqual(a.origin.y, 1)
+            self.assertRaises(ValueError, apply, a, (('name', ('set', 'box')), ('size', ('set', (-1, 2)))))
+            self.assertEqual(a.name, 'square')
+            self.assertRaises(ValueError, apply, a, (('vertices', ('sequence', (('splice', 0, 9, []),
+                ('object', 2, (('x', ('set', 7)), ))))), ))
+            self.assertEqual(a.vertices[2].x, 1)
+            a.mark_clean()
+            apply(a, (('size', ('set', (3, 3))), ('name', ('set', 'big'))))
+            self.assertEqual((a.size, a.name, sorted(a.changed_properties())), ((3, 3), 'big', ['name', 'size']))
+
+        def test_concurrent(self):
+
+            class span(Object):
+                __ultra_concurrent__ = True
+
+                lo = Property(int)
+                hi = Property(int)
+
+                def __init__(self, lo = 0, hi = 0):
+                    super(span, self).__init__()
+                    self.lo = lo
+                    self.hi = hi
+
+                @Invariant
+                def ordered(self):
+                    return self.lo <= self.hi
+
+            a = span(0, 1)
+            apply(a, (('lo', ('set', 5)), ('hi', ('set', 6))))
+            self.assertEqual((a.lo, a.hi), (5, 6))
+            self.assertTrue(a.__ultra_invariant_checks__)
+            self.assertRaises(ValueError, apply, a, (('lo', ('set', 9)), ))
+            self.assertEqual((a.lo, a.hi), (5, 6))
+            self.assertRaises(ValueError, setattr, a, 'lo', 9)
+
+    unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(PatchTests))
@@ -0,0 +1,486 @@
+#/usr/bin/env python
+
+from utils import replace_none
+
+_bits = 5
+_width = 1 << _bits
+_mask = _width - 1
+_hash_bits = 64
+_hash_mask = (1 << _hash_bits) - 1
+
+def _tail_offset(count):
+    if count < _width:
+        return 0
+    return ((count - 1) >> _bits) << _bits
+
+def _new_path(level, node):
+    if level == 0:
+        return node
+    return (_new_path(level - _bits, node), )
+
+def _push_tail(count, level, parent, tail):
+    index = ((count - 1) >> level) & _mask
+    if level == _bits:
+        child = tail
+    elif index < len(parent):
+        child = _push_tail(count, level - _bits, parent[index], tail)
+    else:
+        child = _new_path(level - _bits, tail)
+    return parent[:index] + (child, ) + parent[index + 1:]
+
+def _assoc(level, node, i, val):
+    index = (i >> level) & _mask
+    if level == 0:
+        return node[:index] + (val, ) + node[index + 1:]
+    return node[:index] + (_assoc(level - _bits, node[index], i, val), ) + node[index + 1:]
+
+class PersistentVector(object):
+    __slots__ = ('_count', '_shift', '_root', '_tail', '_type_definition', '_hash')
+
+    def __init__(self, items = (), type_definition = None):
+        items = items if isinstance(items, (list, tuple)) else list(items)
+        count = len(items)
+        tail_offset = _tail_offset(count)
+        shift = _bits
+        root = ()
+        for start in xrange(0, tail_offset, _width):
+            chunk = tuple(items[start:start + _width])
+            if ((start + _width) >> _bits) > (1 << shift):
+                root = (root, _new_path(shift, chunk))
+                shift += _bits
+            else:
+                root = _push_tail(start + _width, shift, root, chunk)
+        self._set(count, shift, root, tuple(items[tail_offset:]), type_definition)
+
+    def _set(self, count, shift, root, tail, type_definition):
+        self._count = count
+        self._shift = shift
+        self._root = root
+        self._tail = tail
+        self._type_definition = type_definition
+        self._hash = None
+
+    def _make(self, count, shift, root, tail):
+        rval = PersistentVector.__new__(PersistentVector)
+        rval._set(count, shift, root, tail, self._type_definition)
+        return rval
+
+    def _leaf(self, i):
+        if i >= _tail_offset(self._count):
+            return self._tail
+        node = self._root
+        level = self._shift
+        while level > 0:
+            node = node[(i >> level) & _mask]
+            level -= _bits
+        return node
+
+    def _index(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError('PersistentVector index out of range')
+        return i
+
+    def _contents(self, val):
+        if self._type_definition is None:
+            return val
+        return self._type_definition._contents.freeze(val)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        i = self._index(i)
+        return self._leaf(i)[i & _mask]
+
+    def __iter__(self):
+        for start in xrange(0, _tail_offset(self._count), _width):
+            for val in self._leaf(start):
+                yield val
+        for val in self._tail:
+            yield val
+
+    def __contains__(self, val):
+        return any(i == val for i in self)
+
+    def set(self, i, val):
+        i = self._index(i)
+        val = self._contents(val)
+        if i >= _tail_offset(self._count):
+            index = i & _mask
+            return self._make(self._count, self._shift, self._root,
+                self._tail[:index] + (val, ) + self._tail[index + 1:])
+        return self._make(self._count, self._shift, _assoc(self._shift, self._root, i, val), self._tail)
+
+    def _append(self, val):
+        count, shift, root = self._count, self._shift, self._root
+        if count - _tail_offset(count) < _width:
+            return self._make(count + 1, shift, root, self._tail + (val, ))
+        if (count >> _bits) > (1 << shift):
+            root = (root, _new_path(shift, self._tail))
+            shift += _bits
+        else:
+            root = _push_tail(count, shift, root, self._tail)
+        return self._make(count + 1, shift, root, (val, ))
+
+    def append(self, val):
+        return self._append(self._contents(val))
+
+    def extend(self, values):
+        rval = self
+        for val in values:
+            rval = rval._append(self._contents(val))
+        return rval
+
+    def thaw(self):
+        return [thaw(i) for i in self]
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (PersistentVector, list, tuple)) or len(other) != self._count:
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(tuple(self))
+        return self._hash
+
+    def __reduce__(self):
+        return (PersistentVector, (list(self), self._type_definition))
+
+    def __repr__(self):
+        return 'PersistentVector(%r)' % list(self)
+
+class _Node(object):
+    __slots__ = ('bitmap', 'array')
+
+    def __init__(self, bitmap, array):
+        self.bitmap = bitmap
+        self.array = array
+
+class _Collision(object):
+    __slots__ = ('entries', )
+
+    def __init__(self, entries):
+        self.entries = entries
+
+def _popcount(i):
+    return bin(i).count('1')
+
+def _hash(key):
+    return hash(key) & _hash_mask
+
+def _merge(first, second, shift):
+    if shift >= _hash_bits:
+        return _Collision((first, second))
+    i = (first[0] >> shift) & _mask
+    j = (second[0] >> shift) & _mask
+    if i == j:
+        return _Node(1 << i, (_merge(first, second, shift + _bits), ))
+    elif i < j:
+        return _Node((1 << i) | (1 << j), (first, second))
+    else:
+        return _Node((1 << i) | (1 << j), (second, first))
+
+def _node_get(node, h, key, default):
+    shift = 0
+    while True:
+        if isinstance(node, _Collision):
+            for entry in node.entries:
+                if entry[1] == key:
+                    return entry[2]
+            return default
+        bit = 1 << ((h >> shift) & _mask)
+        if not node.bitmap & bit:
+            return default
+        entry = node.array[_popcount(node.bitmap & (bit - 1))]
+        if isinstance(entry, tuple):
+            if entry[0] == h and entry[1] == key:
+                return entry[2]
+            return default
+        node = entry
+        shift += _bits
+
+def _node_set(node, shift, entry):
+    if isinstance(node, _Collision):
+        entries = tuple(i for i in node.entries if not i[1] == entry[1])
+        return _Collision(entries + (entry, )), len(entries) == len(node.entries)
+    bit = 1 << ((entry[0] >> shift) & _mask)
+    index = _popcount(node.bitmap & (bit - 1))
+    array = node.array
+    if not node.bitmap & bit:
+        return _Node(node.bitmap | bit, array[:index] + (entry, ) + array[index:]), True
+    current = array[index]
+    if isinstance(current, tuple):
+        if current[0] == entry[0] and current[1] == entry[1]:
+            child, added = entry, False
+        else:
+            child, added = _merge(current, entry, shift + _bits), True
+    else:
+        child, added = _node_set(current, shift + _bits, entry)
+    return _Node(node.bitmap, array[:index] + (child, ) + array[index + 1:]), added
+
+def _node_remove(node, shift, h, key):
+    if isinstance(node, _Collision):
+        entries = tuple(i for i in node.entries if not i[1] == key)
+        if len(entries) == len(node.entries):
+            return node, False
+        if len(entries) == 1:
+            return entries[0], True
+        return _Collision(entries), True
+    bit = 1 << ((h >> shift) & _mask)
+    if not node.bitmap & bit:
+        return node, False
+    index = _popcount(node.bitmap & (bit - 1))
+    current = node.array[index]
+    if isinstance(current, tuple):
+        if current[0] != h or not current[1] == key:
+            return node, False
+        child = None
+    else:
+        child, removed = _node_remove(current, shift + _bits, h, key)
+        if not removed:
+            return node, False
+    if child is None:
+        array = node.array[:index] + node.array[index + 1:]
+        if not array:
+            return None, True
+        if len(array) == 1 and isinstance(array[0], tuple) and shift > 0:
+            return array[0], True
+        return _Node(node.bitmap & ~bit, array), True
+    return _Node(node.bitmap, node.array[:index] + (child, ) + node.array[index + 1:]), True
+
+def _node_entries(node):
+    if isinstance(node, _Collision):
+        for entry in node.entries:
+            yield entry
+        return
+    for entry in node.array:
+        if isinstance(entry, tuple):
+            yield entry
+        else:
+            for i in _node_entries(entry):
+                yield i
+
+_missing = object()
+_empty = _Node(0, ())
+
+class PersistentMap(object):
+    __slots__ = ('_root', '_count', '_type_definition', '_hash')
+
+    def __init__(self, items = (), type_definition = None):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        elif hasattr(items, 'items'):
+            items = items.items()
+        root, count = _empty, 0
+        for key, val in items:
+            root, added = _node_set(root, 0, (_hash(key), key, val))
+            count += added
+        self._set(root, count, type_definition)
+
+    def _set(self, root, count, type_definition):
+        self._root = root
+        self._count = count
+        self._type_definition = type_definition
+        self._hash = None
+
+    def _make(self, root, count):
+        rval = PersistentMap.__new__(PersistentMap)
+        rval._set(root, count, self._type_definition)
+        return rval
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, key):
+        rval = _node_get(self._root, _hash(key), key, _missing)
+        if rval is _missing:
+            raise KeyError(key)
+        return rval
+
+    def get(self, key, default = None):
+        return _node_get(self._root, _hash(key), key, default)
+
+    def __contains__(self, key):
+        return _node_get(self._root, _hash(key), key, _missing) is not _missing
+
+    has_key = __contains__
+
+    def iteritems(self):
+        for entry in _node_entries(self._root):
+            yield entry[1], entry[2]
+
+    def iterkeys(self):
+        for entry in _node_entries(self._root):
+            yield entry[1]
+
+    def itervalues(self):
+        for entry in _node_entries(self._root):
+            yield entry[2]
+
+    __iter__ = iterkeys
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def set(self, key, val):
+        if self._type_definition is not None:
+            if not self._type_definition._key_contents.type_match(key):
+                raise TypeError('%s is not a %s' % (key, self._type_definition._key_contents))
+            val = self._type_definition._value_contents.freeze(val)
+        root, added = _node_set(self._root, 0, (_hash(key), key, val))
+        return self._make(root, self._count + added)
+
+    def update(self, items):
+        rval = self
+        for key, val in PersistentMap(items).iteritems():
+            rval = rval.set(key, val)
+        return rval
+
+    def remove(self, key):
+        root, removed = _node_remove(self._root, 0, _hash(key), key)
+        if not removed:
+            raise KeyError(key)
+        return self._make(replace_none(root, _empty), self._count - 1)
+
+    def thaw(self):
+        return dict((thaw(k), thaw(v)) for k, v in self.iteritems())
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (PersistentMap, dict)) or len(other) != self._count:
+            return False
+        for key, val in self.iteritems():
+            if key not in other or other[key] != val:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self.iteritems()))
+        return self._hash
+
+    def __reduce__(self):
+        return (PersistentMap, (self.items(), self._type_definition))
+
+    def __repr__(self):
+        return 'PersistentMap(%r)' % dict(self.iteritems())
+
+def thaw(val):
+    if isinstance(val, (PersistentVector, PersistentMap)):
+        return val.thaw()
+    elif type(val) is tuple:
+        return tuple(thaw(i) for i in val)
+    return val
+
+if __name__ == '__main__':
+
+    import pickle
+    import random
+    import unittest
+
+    class collide(object):
+
+        def __init__(self, name):
+            self.name = name
+
+        def __hash__(self):
+            return 7
+
+        def __eq__(self, other):
+            return isinstance(other, collide) and self.name == other.name
+
+    class PersistentTests(unittest.TestCase):
+
+        def test_vector(self):
+            for n in (0, 1, 31, 32, 33, 1024, 1025, 32 * 32 * 32 + 70):
+                items = range(n)
+                vector = PersistentVector(items)
+                self.assertEqual(len(vector), n)
+                self.assertEqual(list(vector), items)
+                if n:
+                    self.assertEqual(vector[n - 1], n - 1)
+                    self.assertEqual(vector[-1], n - 1)
+                self.assertRaises(IndexError, vector.__getitem__, n)
+
+        def test_vector_append(self):
+            vector = PersistentVector()
+            versions = [vector]
+            for i in xrange(2000):
+                vector = vector.append(i)
+                versions.append(vector)
+            self.assertEqual(list(vector), range(2000))
+            self.assertEqual(list(versions[1057]), range(1057))
+            self.assertEqual(vector, PersistentVector(range(2000)))
+
+        def test_vector_set(self):
+            vector = PersistentVector(range(5000))
+            changed = vector.set(1234, 'x').set(4999, 'y').set(0, 'z')
+            self.assertEqual(vector[1234], 1234)
+            self.assertEqual((changed[0], changed[1234], changed[4999]), ('z', 'x', 'y'))
+            self.assertEqual(list(changed)[1:1234], range(1, 1234))
+            self.assertTrue(changed._root[2] is vector._root[2])
+
+        def test_vector_hash(self):
+            self.assertEqual(hash(PersistentVector([1, 2])), hash(PersistentVector([1]).append(2)))
+            self.assertEqual(PersistentVector([1, 2]), [1, 2])
+            self.assertEqual([1, 2], PersistentVector([1, 2]))
+            self.assertNotEqual(PersistentVector([1, 2]), [2, 1])
+
+        def test_map(self):
+            keys = range(3000)
+            random.shuffle(keys)
+            mapping = PersistentMap()
+            for k in keys:
+                mapping = mapping.set(k, str(k))
+            self.assertEqual(len(mapping), 3000)
+            self.assertEqual(mapping, dict((k, str(k)) for k in keys))
+            smaller = mapping
+            for k in keys[:2500]:
+                smaller = smaller.remove(k)
+            self.assertEqual(smaller, dict((k, str(k)) for k in keys[2500:]))
+            self.assertEqual(len(mapping), 3000)
+            self.assertRaises(KeyError, smaller.remove, keys[0])
+            self.assertEqual(mapping.set(5, 'five')[5], 'five')
+            self.assertEqual(mapping[5], '5')
+
+        def test_map_collisions(self):
+            mapping = PersistentMap([(collide('a'), 1), (collide('b'), 2), (collide('c'), 3)])
+            self.assertEqual(len(mapping), 3)
+            self.assertEqual(mapping[collide('b')], 2)
+            mapping = mapping.remove(collide('b')).remove(collide('a'))
+            self.assertEqual(mapping.items(), [(collide('c'), 3)])
+
+        def test_map_hash(self):
+            a = PersistentMap({1: 'a', 2: 'b'})
+            b = PersistentMap({2: 'b'}).set(1, 'a')
+            self.assertEqual(hash(a), hash(b))
+            self.assertEqual(a, b)
+            self.assertEqual({1: 'a', 2: 'b'}, a)
+
+        def test_pickle_and_thaw(self):
+            value = PersistentVector([PersistentMap({1: PersistentVector([1, 2])}), PersistentMap()])
+            self.assertEqual(pickle.loads(pickle.dumps(value, 2)), value)
+            self.assertEqual(thaw(value), [{1: [1, 2]}, {}])
+            self.assertEqual(type(thaw(value)[0][1]), list)
+
+    unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(PersistentTests))
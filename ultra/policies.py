@@ -0,0 +1,208 @@
+#/usr/bin/env python
+
+import os
+from collections import deque
+
+class ValidationPolicy(object):
+
+    def __init__(self):
+        self.checks = 0
+        self.skipped = 0
+        self.violations = 0
+        self.recent = deque(maxlen = 16)
+
+    def violation(self, type_definition, val):
+        self.violations += 1
+        self.recent.append((str(type_definition), repr(val)[:80]))
+        return False
+
+    def _type_match(self, type_definition, val):
+        self.checks += 1
+        return type_definition.type_match(val) or self.violation(type_definition, val)
+
+    def _contents_match(self, type_definition, val, key):
+        self.checks += 1
+        return type_definition.contents_match(val, key) or self.violation(type_definition, (key, val))
+
+    def type_match(self, type_definition, val):
+        return self._type_match(type_definition, val)
+
+    def contents_match(self, type_definition, val, key = None):
+        return self._contents_match(type_definition, val, key)
+
+    def _contents_match_many(self, type_definition, values):
+        self.checks += 1
+        return type_definition.contents_match_many(values) or self.violation(type_definition, values)
+
+    def contents_match_many(self, type_definition, values):
+        return self._contents_match_many(type_definition, values)
+
+    def stats(self):
+        return { 'checks' : self.checks, 'skipped' : self.skipped, 'violations' : self.violations,
+                 'recent' : list(self.recent) }
+
+class Full(ValidationPolicy):
+    pass
+
+class Sampled(ValidationPolicy):
+
+    def __init__(self, rate):
+        super(Sampled, self).__init__()
+        self.rate = rate
+        self._count = 0
+
+    def _sample(self):
+        self._count += 1
+        if self._count >= self.rate:
+            self._count = 0
+            return True
+        self.skipped += 1
+        return False
+
+    def type_match(self, type_definition, val):
+        return not self._sample() or self._type_match(type_definition, val)
+
+    def contents_match(self, type_definition, val, key = None):
+        return not self._sample() or self._contents_match(type_definition, val, key)
+
+    def contents_match_many(self, type_definition, values):
+        return not self._sample() or self._contents_match_many(type_definition, values)
+
+class Prefix(ValidationPolicy):
+
+    def __init__(self, count):
+        super(Prefix, self).__init__()
+        self.count = count
+
+    def type_match(self, type_definition, val):
+        self.checks += 1
+        return type_definition.type_match_prefix(val, self.count) or self.violation(type_definition, val)
+
+    def contents_match_many(self, type_definition, values):
+        return self._contents_match_many(type_definition, values[:self.count])
+
+class Off(ValidationPolicy):
+
+    def type_match(self, type_definition, val):
+        self.skipped += 1
+        return True
+
+    def contents_match(self, type_definition, val, key = None):
+        self.skipped += 1
+        return True
+
+    def contents_match_many(self, type_definition, values):
+        self.skipped += 1
+        return True
+
+full = Full()
+force_full = os.environ.get('ULTRA_VALIDATION', '').lower() == 'full'
+_default = [full]
+
+def default_policy():
+    return _default[0]
+
+def set_default_policy(policy):
+    _default[0] = policy
+
+def resolve(type_definition, policy = None):
+    if force_full:
+        return full
+    return type_definition._policy or policy or _default[0]
+
+if __name__ == '__main__':
+
+    import unittest
+    from magic import Object, Property
+    from type_definition import TypeDefinition, ListProxy
+    from utils import replace_none
+
+    sampled = Sampled(4)
+
+    class hot(Object):
+        __ultra_validation__ = sampled
+
+        a = Property(int)
+        b = Property([int])
+        c = Property([int], policy = Prefix(2))
+        d = Property(int, policy = full)
+
+        def __init__(self):
+            super(hot, self).__init__()
+            self.a = 0
+            self.b = []
+            self.c = []
+            self.d = 0
+
+    class PolicyTests(unittest.TestCase):
+
+        def setUp(self):
+            sampled._count = 0
+
+        def test_default(self):
+            self.assertTrue(default_policy() is full)
+            self.assertTrue(resolve(TypeDefinition(int)) is full)
+            self.assertTrue(resolve(TypeDefinition(int), sampled) is sampled)
+            self.assertTrue(resolve(TypeDefinition(int, policy = full), sampled) is full)
+
+        def test_sampled(self):
+            i = hot()
+            results = []
+            for k in xrange(8):
+                try:
+                    i.a = 'x'
+                    results.append(True)
+                except TypeError:
+                    results.append(False)
+            self.assertEqual(results.count(False), 2)
+            self.assertTrue(sampled.violations >= 2)
+            self.assertEqual(sampled.recent[-1], ('int', "'x'"))
+
+        def test_sampled_proxy(self):
+            i = hot()
+            failures = 0
+            for k in xrange(8):
+                try:
+                    i.b.append('x')
+                except TypeError:
+                    failures += 1
+            self.assertEqual(failures, 2)
+
+        def test_prefix(self):
+            i = hot()
+            i.c = [1, 2, 'three']
+            self.assertRaises(TypeError, setattr, i, 'c', [1, 'two', 3])
+            self.assertEqual(hot.__ultra__['c'][1]._policy.violations, 1)
+
+        def test_prefix_nested(self):
+
+            class grid(Object):
+                n = Property([[int]], policy = Prefix(2))
+
+                def __init__(self, n = None):
+                    super(grid, self).__init__()
+                    self.n = replace_none(n, [])
+
+            src, dst = grid([[1], [2], [3]]), grid()
+            dst.n = src.n
+            self.assertEqual([type(k) for k in list.__iter__(src.n)], [list, list, list])
+            self.assertEqual(dst.n, [[1], [2], [3]])
+
+        def test_property_overrides_class(self):
+            i = hot()
+            for k in xrange(4):
+                self.assertRaises(TypeError, setattr, i, 'd', 'x')
+
+        def test_global(self):
+            import policies
+            off = policies.Off()
+            policies.set_default_policy(off)
+            try:
+                proxy = ListProxy([]).withtype(TypeDefinition([int]))
+                proxy.append('a')
+                self.assertEqual(off.skipped, 1)
+            finally:
+                policies.set_default_policy(policies.full)
+            self.assertRaises(TypeError, proxy.append, 'b')
+
+    unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(PolicyTests))
@@ -0,0 +1,237 @@
+#/usr/bin/env python
+
+import re
+from ast import literal_eval
+from type_definition import TypeDefinition, leaf_name, tuple_name, sequence_name, mapping_name
+
+_token = re.compile(r'''\.?([A-Za-z_]\w*)|\[([^\]]*)\]|\{((?:'[^']*'|"[^"]*"|[^}'"])*)\}''')
+_index = re.compile(r'-?\d+$')
+_predicate = re.compile(r'\?([A-Za-z_]\w*)$')
+
+class Query(object):
+
+    def __init__(self, cls, path, **predicates):
+        if not hasattr(cls, '__ultra__'):
+            raise TypeError('%s is not an ultra Object' % cls)
+        self.cls = cls
+        self.path = path
+        self._namespace = {}
+        self._lines = ['def query(roots, append):', '    for v0 in roots:']
+        self._depth = 0
+        self._indent = 2
+        type_description = TypeDefinition(cls)
+        position = 0
+        while position < len(path):
+            match = _token.match(path, position)
+            if match is None or match.end() == position:
+                raise ValueError('Cannot parse %r at position %d' % (path, position))
+            position = match.end()
+            name, index, key = match.groups()
+            if name is not None:
+                type_description = self._property(type_description, name)
+            elif index is not None:
+                type_description = self._sequence(type_description, index.strip(), predicates)
+            else:
+                type_description = self._mapping(type_description, key.strip(), predicates)
+        self._emit('append(v%d)' % self._depth)
+        self.type_definition = type_description
+        self.source = '\n'.join(self._lines)
+        exec self.source in self._namespace
+        self._query = self._namespace['query']
+
+    def _emit(self, line, nested = False):
+        self._lines.append('    ' * self._indent + line)
+        if nested:
+            self._indent += 1
+
+    def _step(self):
+        self._depth += 1
+        return 'v%d' % (self._depth - 1), 'v%d' % self._depth
+
+    def _constant(self, val):
+        name = 'c%d' % len(self._namespace)
+        self._namespace[name] = val
+        return name
+
+    def _lookup(self, predicates, name):
+        if name not in predicates:
+            raise ValueError('No predicate named %s in %r' % (name, self.path))
+        return self._constant(predicates[name])
+
+    def _property(self, type_description, name):
+        if type_description._category != leaf_name or not hasattr(type_description._type, '__ultra__'):
+            raise TypeError('.%s needs an Object, not a %s' % (name, type_description))
+        cls = type_description._type
+        if name not in cls.__ultra__:
+            raise ValueError('%s has no property %s' % (cls.__name__, name))
+        current, target = self._step()
+        self._emit('%s = %s.%s' % (target, current, name))
+        return cls.__ultra__[name][1]
+
+    def _sequence(self, type_description, index, predicates):
+        category = type_description._category
+        if category == tuple_name and _index.match(index):
+            i = int(index)
+            if not -len(type_description._tuple_contents) <= i < len(type_description._tuple_contents):
+                raise ValueError('[%d] is out of range for a %s' % (i, type_description))
+            current, target = self._step()
+            self._emit('%s = %s[%d]' % (target, current, i))
+            return type_description._tuple_contents[i]
+        if category != sequence_name:
+            raise TypeError('[%s] needs a sequence, not a %s' % (index, type_description))
+        current, target = self._step()
+        if index == '*':
+            self._emit('for %s in %s:' % (target, current), True)
+        elif _index.match(index):
+            self._emit('if %s <= len(%s):' % (-int(index) if index[0] == '-' else int(index) + 1, current),
+                True)
+            self._emit('%s = %s[%s]' % (target, current, index))
+        elif _predicate.match(index):
+            predicate = self._lookup(predicates, index[1:])
+            self._emit('for %s in %s:' % (target, current), True)
+            self._emit('if %s(%s):' % (predicate, target), True)
+        else:
+            raise ValueError('Cannot parse [%s] in %r' % (index, self.path))
+        return type_description._contents
+
+    def _mapping(self, type_description, key, predicates):
+        if type_description._category != mapping_name:
+            raise TypeError('{%s} needs a mapping, not a %s' % (key, type_description))
+        current, target = self._step()
+        if key == '*':
+            self._emit('for %s in %s.itervalues():' % (target, current), True)
+        elif key == '~':
+            self._emit('for %s in %s.iterkeys():' % (target, current), True)
+            return type_description._key_contents
+        elif _predicate.match(key):
+            predicate = self._lookup(predicates, key[1:])
+            self._emit('for k, %s in %s.iteritems():' % (target, current), True)
+            self._emit('if %s(k):' % predicate, True)
+        else:
+            try:
+                val = literal_eval(key)
+            except (ValueError, SyntaxError):
+                raise ValueError('Cannot parse {%s} in %r' % (key, self.path))
+            if not type_description._key_contents.type_match(val):
+                raise TypeError('%r is not a %s key' % (val, type_description._key_contents))
+            constant = self._constant(val)
+            self._emit('if %s in %s:' % (constant, current), True)
+            self._emit('%s = %s[%s]' % (target, current, constant))
+        return type_description._value_contents
+
+    def __call__(self, obj):
+        rval = []
+        self._query((obj, ), rval.append)
+        return rval
+
+    def all(self, objs):
+        rval = []
+        self._query(objs, rval.append)
+        return rval
+
+if __name__ == '__main__':
+
+    import sys
+    import time
+    import unittest
+    from xml.etree import ElementTree
+    from magic import Object, Property
+    from xmlmixin import _xml
+    from utils import replace_none
+
+    class point(Object, _xml):
+        x = Property(int)
+        y = Property(int)
+
+        def __init__(self, x = 0, y = 0):
+            super(point, self).__init__()
+            self.x = x
+            self.y = y
+
+    class shape(Object, _xml):
+        name = Property(str)
+        vertices = Property([point])
+        cells = Property([{(int, int): str}])
+        anchors = Property({str: point})
+        size = Property((int, point))
+
+        def __init__(self, name = '', vertices = None, cells = None, anchors = None, size = None):
+            super(shape, self).__init__()
+            self.name = name
+            self.vertices = replace_none(vertices, [])
+            self.cells = replace_none(cells, [])
+            self.anchors = replace_none(anchors, {})
+            self.size = replace_none(size, (0, point()))
+
+    class frozen_shape(Object):
+        __ultra_frozen__ = True
+
+        cells = Property([{(int, int): str}])
+
+        def __init__(self, cells = None):
+            super(frozen_shape, self).__init__()
+            self.cells = replace_none(cells, [])
+
+    def square(n = 0):
+        return shape('square%d' % n, [point(0, 0), point(0, n), point(n, n), point(n, 0)],
+            [{(0, 0): 'a', (0, 1): 'b'}, {(1, 1): 'c'}], {'centre': point(n, n)}, (2, point(1, n)))
+
+    class QueryTests(unittest.TestCase):
+
+        def test_property(self):
+            self.assertEqual(Query(shape, 'name')(square(3)), ['square3'])
+            self.assertEqual(Query(shape, 'size[1].y')(square(3)), [3])
+            self.assertEqual(Query(shape, 'anchors{"centre"}.x')(square(2)), [2])
+            self.assertEqual(Query(shape, 'anchors{"missing"}.x')(square(2)), [])
+
+        def test_wildcards(self):
+            self.assertEqual(Query(shape, 'vertices[*].y')(square(2)), [0, 2, 2, 0])
+            self.assertEqual(sorted(Query(shape, 'cells[*]{*}')(square())), ['a', 'b', 'c'])
+            self.assertEqual(sorted(Query(shape, 'cells[*]{~}[0]')(square())), [0, 0, 1])
+            self.assertEqual(Query(shape, 'cells[0]{(0, 1)}')(square()), ['b'])
+            self.assertEqual(Query(shape, 'cells[-1]{(1, 1)}')(square()), ['c'])
+            self.assertEqual(Query(shape, 'cells[5]{*}')(square()), [])
+
+        def test_predicates(self):
+            diagonal = Query(shape, 'cells[*]{?diagonal}', diagonal = lambda k: k[0] == k[1])
+            self.assertEqual(sorted(diagonal(square())), ['a', 'c'])
+            right = Query(shape, 'vertices[?right].y', right = lambda p: p.x > 0)
+            self.assertEqual(right.all([square(1), square(2)]), [1, 0, 2, 0])
+
+        def test_schema(self):
+            self.assertEqual(Query(shape, 'vertices[*]').type_definition._type, point)
+            self.assertEqual(str(Query(shape, 'cells[*]{~}').type_definition), str(TypeDefinition((int, int))))
+            self.assertRaises(ValueError, Query, shape, 'colour')
+            self.assertRaises(ValueError, Query, shape, 'vertices[*].z')
+            self.assertRaises(TypeError, Query, shape, 'name[*]')
+            self.assertRaises(TypeError, Query, shape, 'vertices{*}')
+            self.assertRaises(TypeError, Query, shape, 'anchors[*]')
+            self.assertRaises(TypeError, Query, shape, 'cells[*]{"a"}')
+            self.assertRaises(ValueError, Query, shape, 'size[2]')
+            self.assertRaises(ValueError, Query, shape, 'vertices[?missing]')
+            self.assertRaises(ValueError, Query, shape, 'vertices[*]..x')
+            self.assertRaises(TypeError, Query, int, 'x')
+
+        def test_frozen(self):
+            i = frozen_shape([{(0, 0): 'a', (0, 1): 'b'}, {(1, 1): 'c'}])
+            self.assertEqual(sorted(Query(frozen_shape, 'cells[*]{*}')(i)), ['a', 'b', 'c'])
+            self.assertEqual(Query(frozen_shape, 'cells[1]{(1, 1)}')(i), ['c'])
+
+    if '--benchmark' in sys.argv:
+        shapes = [square(i) for i in xrange(20000)]
+        query = Query(shape, 'vertices[*].y')
+        start = time.time()
+        result = query.all(shapes)
+        compiled = time.time() - start
+        start = time.time()
+        expected = [v.y for s in shapes for v in s.vertices]
+        loop = time.time() - start
+        start = time.time()
+        found = [int(i.text) for s in shapes for i in s.to_xml().findall('vertices/point/y')]
+        xml = time.time() - start
+        assert result == expected == found
+        print 'compiled query %8.3fs' % compiled
+        print 'hand loop      %8.3fs' % loop
+        print 'to_xml+findall %8.3fs' % xml
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(QueryTests))
@@ -1,7 +1,11 @@
 #/usr/bin/env python
 
-from itertools import izip
+from itertools import izip, islice
+from caching import ValidationCache
+from interning import InternTable
+from persistent import PersistentVector, PersistentMap, thaw
 from utils import replace_none
+import policies
 import validators
 import unittest
 
@@ -110,28 +114,105 @@ class ContainerTests(unittest.TestCase):
         test_tuple = TupleProxy((1, 2, 3))
         self.assertRaises(TypeError, test_tuple.withtype, type_def)
 
-def InvariantChecked(self, func):
-    
-    def wrapper(val):
-        func(val)
-        self._invariant_checks()
-        
-    return wrapper
-    
-class WithMixin(object):
+    def test_pickle(self):
+        import pickle
+        test_list = ListProxy([1, 2, 3]).withtype(TypeDefinition([int]))
+        test_map = DictionaryProxy({'a': 1}).withtype(TypeDefinition({str: int}))
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            loaded_list = pickle.loads(pickle.dumps(test_list, protocol))
+            self.assertEqual(loaded_list, [1, 2, 3])
+            self.assertRaises(TypeError, loaded_list.append, 'a')
+            loaded_map = pickle.loads(pickle.dumps(test_map, protocol))
+            self.assertEqual(loaded_map, {'a': 1})
+            self.assertRaises(TypeError, loaded_map.__setitem__, 'b', 'b')
+            self.assertEqual(pickle.loads(pickle.dumps(ListProxy([1]), protocol)), [1])
 
-    def __with(self, type_definition = None, invariant_checks = None):
-        self._type_definition = replace_none(getattr(self, '_type_definition', None), type_definition)
-        self._invariant_checks = replace_none(getattr(self, '_invariant_checks', None), invariant_checks)
-        
-        methods, proxies = self.proxy_definitions()
-        if self._type_definition:
-            for method, proxy in izip(methods, proxies):
-                setattr(self, method, proxy)
-        if self._invariant_checks:
-            for method in methods:
-                setattr(self, method, InvariantChecked(self, getattr(self, method)))
+    def test_list_mutations(self):
+        test_list = ListProxy([1, 2, 3]).withtype(TypeDefinition([int]))
+        test_list[0] = 0
+        test_list[1:2] = [5, 6]
+        test_list += [7]
+        test_list.extend(xrange(8, 10))
+        test_list.insert(-1, 4)
+        test_list.insert_many(0, [-2, -1])
+        test_list[::2] = [10] * 5
+        self.assertEqual(test_list, [10, -1, 10, 5, 10, 3, 10, 8, 10, 9])
+        for mutation in [lambda: test_list.__setitem__(0, 'a'), lambda: test_list.__setslice__(0, 1, ['a']),
+                lambda: test_list.__iadd__(['a']), lambda: test_list.extend([1, 'a']),
+                lambda: test_list.insert(0, 'a'), lambda: test_list.insert_many(0, [1, 'a']),
+                lambda: test_list.__setitem__(slice(None, None, 5), [1, 'a'])]:
+            self.assertRaises(TypeError, mutation)
+        self.assertEqual(test_list, [10, -1, 10, 5, 10, 3, 10, 8, 10, 9])
+        del test_list[0]
+        del test_list[-2:]
+        test_list.remove(5)
+        self.assertEqual(test_list.pop(), 8)
+        test_list *= 2
+        test_list.sort()
+        test_list.reverse()
+        self.assertEqual(test_list, [10] * 6 + [3, 3, -1, -1])
+        self.assertEqual(type(test_list), ListProxy)
+
+    def test_dict_mutations(self):
+        test_map = DictionaryProxy({'a': 1}).withtype(TypeDefinition({str: int}))
+        test_map['b'] = 2
+        test_map.update({'c': 3}, d = 4)
+        test_map.update([('e', 5)])
+        self.assertEqual(test_map.setdefault('a', 10), 1)
+        self.assertEqual(test_map.setdefault('f', 6), 6)
+        self.assertEqual(test_map, {'a': 1, 'b': 2, 'c': 3, 'd': 4, 'e': 5, 'f': 6})
+        for mutation in [lambda: test_map.__setitem__('g', 'a'), lambda: test_map.update({'g': 7, 8: 8}),
+                lambda: test_map.update(g = 'a'), lambda: test_map.setdefault('g')]:
+            self.assertRaises(TypeError, mutation)
+        self.assertEqual(len(test_map), 6)
+        del test_map['a']
+        self.assertEqual(test_map.pop('b'), 2)
+        self.assertEqual(test_map.pop('b', None), None)
+        test_map.popitem()
+        test_map.clear()
+        self.assertEqual(test_map, {})
 
+    def test_incremental(self):
+        checked = []
+        def counted(val):
+            checked.append(val)
+            return True
+        calls = []
+        test_list = ListProxy(range(1000)).withtrusted(TypeDefinition([Specification(int, validation = counted)]),
+            lambda: calls.append(None), tracker = lambda proxy, change: calls.append(change))
+        test_list.extend([1, 2, 3])
+        test_list += [4]
+        test_list.insert_many(10, [5, 6])
+        test_list[20] = 7
+        self.assertEqual(checked, [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(calls, [('append', 1000, 1003), None, ('append', 1003, 1004), None,
+            ('setslice', 10, 10, 2), None, ('setslice', 20, 21, 1), None])
+        del calls[:]
+        test_map = DictionaryProxy(dict.fromkeys(range(1000), 0)).withtrusted(
+            TypeDefinition({int: Specification(int, validation = counted)}), lambda: calls.append(None),
+            tracker = lambda proxy, change: calls.append(change))
+        test_map.update({1: 8, 2000: 9})
+        del test_map[1]
+        self.assertEqual(sorted(checked[-2:]), [8, 9])
+        self.assertEqual(sorted(calls[:2]), [('set', 1), ('set', 2000)])
+        self.assertEqual(calls[2:], [None, ('delete', 1), None])
+
+class WithMixin(object):
+    _type_definition = None
+    _invariant_checks = None
+    _lock = None
+    _tracker = None
+    _policy = None
+    _parent = None
+    _position = None
+
+    def __with(self, type_definition = None, invariant_checks = None, lock = None, tracker = None,
+            policy = None):
+        self._type_definition = replace_none(self._type_definition, type_definition)
+        self._invariant_checks = replace_none(self._invariant_checks, invariant_checks)
+        self._lock = replace_none(self._lock, lock)
+        self._tracker = replace_none(self._tracker, tracker)
+        self._policy = replace_none(self._policy, policy)
         return self             
 
     def withtype(self, type_definition):
@@ -142,44 +223,346 @@ class WithMixin(object):
     def withinvariants(self, invariant_checks):
         invariant_checks()
         return self.__with(invariant_checks = invariant_checks)
+
+    def withtrusted(self, type_definition, invariant_checks = None, lock = None, tracker = None,
+            policy = None):
+        return self.__with(type_definition = type_definition, invariant_checks = invariant_checks,
+            lock = lock, tracker = tracker, policy = policy)
+
+    def withlock(self, lock):
+        return self.__with(lock = lock)
+
+    def withtracker(self, tracker):
+        return self.__with(tracker = tracker)
+
+    def withpolicy(self, policy):
+        return self.__with(policy = policy)
+
+    def __reduce__(self):
+        if self._type_definition is None:
+            return (type(self), (self._container(self), ))
+        return (_restore_proxy, (type(self), self._container(self), self._type_definition))
+
+    def _mutate(self, func, *args):
+        if self._lock is None:
+            rval = func(*args)
+            if self._invariant_checks is not None:
+                self._invariant_checks()
+            return rval
+        with self._lock:
+            rval = func(*args)
+            if self._invariant_checks is not None:
+                self._invariant_checks()
+            return rval
+
+    def _changed(self, change):
+        if self._tracker is not None:
+            self._tracker(self, change)
+
+    def _validate_many(self, values, description):
+        if self._type_definition is None:
+            return values
+        if not policies.resolve(self._type_definition, self._policy).contents_match_many(
+                self._type_definition, values):
+            raise TypeError('%s is not a valid %s for a %s' % (values, description, self._type_definition))
+        return self._type_definition.intern_many(values)
+
+    def _child(self, type_definition, position, val):
+        if self._lock is None:
+            return self.__wrap(type_definition, position, val)
+        with self._lock:
+            return self.__wrap(type_definition, position, val)
+
+    def __wrap(self, type_definition, position, val):
+        current = self._container.__getitem__(self, position)
+        if current is not val:
+            return current
+        val = type_definition.proxy(val, self._invariant_checks, trusted = True, lock = self._lock,
+            tracker = self._child_changed, policy = self._policy)
+        val._parent = self
+        val._position = position
+        self._container.__setitem__(self, position, val)
+        return val
         
-    def proxy_definitions(self):
-        raise NotImplementedError()
-        
+def _restore_proxy(proxy, val, type_definition):
+    return proxy(val).withtrusted(type_definition)
+
+def _position(i, length):
+    if i < 0:
+        i += length
+    return max(0, min(i, length))
+
 class ListProxy(list, WithMixin):
+    _container = list
 
-    def proxy_definitions(self):
-        return ['append', '__setslice__'], [self.__append_type_safe, self.__setslice_type_safe]
+    def append(self, val):
+        return self._mutate(self.__append, val)
 
-    def __append_type_safe(self, val):
-        if self._type_definition.contents_match(val, None):
-            super(ListProxy, self).append(val)
-        else:
-            raise TypeError('%s is a %s and cannot be appended to a %s' % 
-                (val, type(val), self._type_definition))
+    def extend(self, values):
+        return self._mutate(self.__extend, values)
 
-    def __setslice_type_safe(self, i, j, val):
-        if self._type_definition.type_match(val):
-            return super(ListProxy, self).__setslice__(i, j, val)
-        else:
-            raise TypeError('%s is not a %s' % (val, self._type_definition))        
+    def __iadd__(self, values):
+        self._mutate(self.__extend, values)
+        return self
+
+    def insert(self, i, val):
+        return self._mutate(self.__insert_many, i, [val])
+
+    def insert_many(self, i, values):
+        return self._mutate(self.__insert_many, i, values)
+
+    def __setitem__(self, i, val):
+        return self._mutate(self.__setitem, i, val)
+
+    def __setslice__(self, i, j, values):
+        return self._mutate(self.__setslice, i, j, values)
+
+    def __imul__(self, n):
+        self._mutate(self.__repeat, n)
+        return self
 
+    def __delitem__(self, i):
+        return self._mutate(self.__delitem, i)
+
+    def __delslice__(self, i, j):
+        return self._mutate(self.__setslice, i, j, [])
+
+    def pop(self, i = -1):
+        return self._mutate(self.__pop, i)
+
+    def remove(self, val):
+        return self._mutate(self.__remove, val)
+
+    def sort(self, *args, **kwargs):
+        return self._mutate(self.__reorder, super(ListProxy, self).sort, args, kwargs)
+
+    def reverse(self):
+        return self._mutate(self.__reorder, super(ListProxy, self).reverse, (), {})
+
+    def __append(self, val):
+        type_definition = self._type_definition
+        if type_definition is not None:
+            if not policies.resolve(type_definition, self._policy).contents_match(type_definition, val):
+                raise TypeError('%s is a %s and cannot be appended to a %s' % 
+                    (val, type(val), type_definition))
+            if type_definition._interns:
+                val = type_definition._contents.intern(val)
+        super(ListProxy, self).append(val)
+        self._changed(('append', len(self) - 1, len(self)))
+
+    def __extend(self, values):
+        values = self._validate_many(list(values), 'extension')
+        start = len(self)
+        super(ListProxy, self).extend(values)
+        if values:
+            self._changed(('append', start, len(self)))
+
+    def __insert_many(self, i, values):
+        i = _position(i, len(self))
+        self.__setslice(i, i, values)
+
+    def __setitem(self, i, val):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return self.__setslice(start, max(start, stop), val)
+            indices = xrange(start, stop, step)
+            val = self._validate_many(list(val), 'slice')
+            super(ListProxy, self).__setitem__(i, val)
+            if indices:
+                start, stop = min(indices), max(indices) + 1
+                self._changed(('setslice', start, stop, stop - start))
+            return
+        val = self._validate_many([val], 'item')[0]
+        super(ListProxy, self).__setitem__(i, val)
+        i = i + len(self) if i < 0 else i
+        self._changed(('setslice', i, i + 1, 1))
+
+    def __setslice(self, i, j, values):
+        values = self._validate_many(list(values), 'slice')
+        i = max(0, min(i, len(self)))
+        j = max(i, min(j, len(self)))
+        if i == j and not values:
+            return
+        super(ListProxy, self).__setslice__(i, j, values)
+        self._changed(('setslice', i, j, len(values)))
+
+    def __repeat(self, n):
+        before = len(self)
+        super(ListProxy, self).__imul__(n)
+        if len(self) > before:
+            self._changed(('append', before, len(self)))
+        elif len(self) < before:
+            self._changed(('setslice', 0, before, 0))
+
+    def __delitem(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return self.__setslice(start, max(start, stop), [])
+            indices = xrange(start, stop, step)
+            super(ListProxy, self).__delitem__(i)
+            if indices:
+                start, stop = min(indices), max(indices) + 1
+                self._changed(('setslice', start, stop, stop - start - len(indices)))
+            return
+        super(ListProxy, self).__delitem__(i)
+        i = i + len(self) + 1 if i < 0 else i
+        self._changed(('setslice', i, i + 1, 0))
+
+    def __pop(self, i):
+        rval = super(ListProxy, self).pop(i)
+        i = i + len(self) + 1 if i < 0 else i
+        self._changed(('setslice', i, i + 1, 0))
+        return rval
+
+    def __remove(self, val):
+        i = self.index(val)
+        super(ListProxy, self).__delitem__(i)
+        self._changed(('setslice', i, i + 1, 0))
+
+    def __reorder(self, func, args, kwargs):
+        func(*args, **kwargs)
+        if self:
+            self._changed(('setslice', 0, len(self), len(self)))
             
 class TupleProxy(tuple, WithMixin):
-
-    def proxy_definitions(self):
-        return [], []
+    _container = tuple
     
 class DictionaryProxy(dict, WithMixin):
+    _container = dict
 
-    def proxy_definitions(self):
-        return ['__setitem__'], [self.__setitem_type_safe]
+    def __setitem__(self, key, val):
+        return self._mutate(self.__setitem, key, val)
 
-    def __setitem_type_safe(self, key, val):
-        if self._type_definition.contents_match(val, key):
-            super(DictionaryProxy, self).__setitem__(key, val)
-        else:
-            raise TypeError('%s is not a %s' % ((key, val), self._type_definition))
+    def update(self, *args, **kwargs):
+        return self._mutate(self.__update, dict(*args, **kwargs))
+
+    def setdefault(self, key, val = None):
+        return self._mutate(self.__setdefault, key, val)
+
+    def __delitem__(self, key):
+        return self._mutate(self.__delitem, key)
+
+    def pop(self, key, *default):
+        return self._mutate(self.__pop, key, default)
+
+    def popitem(self):
+        return self._mutate(self.__popitem)
+
+    def clear(self):
+        return self._mutate(self.__clear)
+
+    def __setitem(self, key, val):
+        type_definition = self._type_definition
+        if type_definition is not None:
+            if not policies.resolve(type_definition, self._policy).contents_match(type_definition, val, key):
+                raise TypeError('%s is not a %s' % ((key, val), type_definition))
+            if type_definition._interns:
+                key = type_definition._key_contents.intern(key)
+                val = type_definition._value_contents.intern(val)
+        super(DictionaryProxy, self).__setitem__(key, val)
+        self._changed(('set', key))
+
+    def __update(self, items):
+        items = self._validate_many(items.items(), 'update')
+        super(DictionaryProxy, self).update(items)
+        for key, val in items:
+            self._changed(('set', key))
+
+    def __setdefault(self, key, val):
+        if key not in self:
+            self.__setitem(key, val)
+        return self[key]
+
+    def __delitem(self, key):
+        super(DictionaryProxy, self).__delitem__(key)
+        self._changed(('delete', key))
+
+    def __pop(self, key, default):
+        if key not in self:
+            return super(DictionaryProxy, self).pop(key, *default)
+        rval = super(DictionaryProxy, self).pop(key)
+        self._changed(('delete', key))
+        return rval
+
+    def __popitem(self):
+        key, val = super(DictionaryProxy, self).popitem()
+        self._changed(('delete', key))
+        return key, val
+
+    def __clear(self):
+        keys = self.keys()
+        super(DictionaryProxy, self).clear()
+        for key in keys:
+            self._changed(('delete', key))
+
+class NestedListProxy(ListProxy):
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in xrange(*i.indices(len(self)))]
+        val = super(NestedListProxy, self).__getitem__(i)
+        if getattr(val, '_parent', None) is not self and self._type_definition is not None:
+            return self._child(self._type_definition._contents, i + len(self) if i < 0 else i, val)
+        return val
+
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(i, j))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def _child_changed(self, child, change):
+        i = child._position
+        if i >= len(self) or super(NestedListProxy, self).__getitem__(i) is not child:
+            for i, val in enumerate(super(NestedListProxy, self).__iter__()):
+                if val is child:
+                    child._position = i
+                    break
+            else:
+                return
+        self._changed(('setslice', i, i + 1, 1))
+
+class NestedDictionaryProxy(DictionaryProxy):
+
+    def __getitem__(self, key):
+        val = super(NestedDictionaryProxy, self).__getitem__(key)
+        if getattr(val, '_parent', None) is not self and self._type_definition is not None:
+            return self._child(self._type_definition._value_contents, key, val)
+        return val
+
+    def get(self, key, default = None):
+        return self[key] if key in self else default
+
+    def itervalues(self):
+        for key in self.iterkeys():
+            yield self[key]
+
+    def iteritems(self):
+        for key in self.iterkeys():
+            yield key, self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def _child_changed(self, child, change):
+        if super(NestedDictionaryProxy, self).get(child._position) is child:
+            self._changed(('set', child._position))
+
+def raw_values(val):
+    if isinstance(val, list):
+        return list.__iter__(val)
+    return iter(val)
+
+def raw_items(val):
+    if isinstance(val, dict):
+        return dict.iteritems(val)
+    return val.iteritems()
 
 leaf_name = 'leaf'
 tuple_name = 'tuple'
@@ -200,10 +583,10 @@ type_match_definitions = {
                     len(val) == len(self._tuple_contents)),
 
     sequence_name: lambda self, val: (isinstance(val, self._container) and
-                    all(self.contents_match(i) for i in val)),
+                    all(self.contents_match(i) for i in raw_values(val))),
 
     mapping_name: lambda self, val: (isinstance(val, self._container) and 
-                    all(self.contents_match(v, k) for (k, v) in val.items())) }
+                    all(self.contents_match(v, k) for (k, v) in raw_items(val))) }
             
 contents_match_definitions = {
     sequence_name: lambda self, val, key: self._contents.type_match(val),
@@ -228,6 +611,8 @@ class TypeDefinition(object):
         if isinstance(argument, Specification):
             prototype = argument.prototype
             self.restrictions = argument.restrictions
+            if kwargs:
+                self.restrictions = dict(argument.restrictions, **kwargs)
         else:
             prototype = argument
             self.restrictions = kwargs
@@ -237,19 +622,55 @@ class TypeDefinition(object):
             self._proxy, self._category = container_definitions[type(prototype)]
             if self._category == sequence_name:
                 self._contents = TypeDefinition(prototype[0])
+                self._leaf_only = self._contents._immutable
+                if self._contents._category in (sequence_name, mapping_name):
+                    self._proxy = NestedListProxy
             elif self._category == mapping_name:
                 self._key_contents = TypeDefinition(prototype.keys()[0])
                 self._value_contents = TypeDefinition(prototype.values()[0])
+                self._leaf_only = self._value_contents._immutable
+                if self._value_contents._category in (sequence_name, mapping_name):
+                    self._proxy = NestedDictionaryProxy
             elif self._category == tuple_name:
                 self._tuple_contents = tuple(TypeDefinition(i) for i in prototype)
+                self._leaf_only = all(i._immutable for i in self._tuple_contents)
+            self._immutable = self._category == tuple_name and self._leaf_only
         else:
             self._category = leaf_name
             self._type = prototype
+            self._immutable = not hasattr(prototype, '__ultra__')
+
+        self._policy = self.restrictions.get('policy')
+        self._cache = self.restrictions.get('cache')
+        if self._cache is True:
+            self._cache = ValidationCache()
+        elif self._cache is False:
+            self._cache = None
+        elif isinstance(self._cache, (int, long)):
+            if self._cache < 1:
+                raise ValueError('cache size must be at least 1, not %d' % self._cache)
+            self._cache = ValidationCache(self._cache)
+        self._interner = self.restrictions.get('intern')
+        if self._interner is True:
+            self._interner = InternTable()
+        if self._category == sequence_name:
+            self._interns = self._contents._interner is not None
+        elif self._category == mapping_name:
+            self._interns = self._key_contents._interner is not None or self._value_contents._interner is not None
+        elif self._category == tuple_name:
+            self._interns = any(i._interner is not None for i in self._tuple_contents)
+        else:
+            self._interns = self._interner is not None
 
     def subhandler(self, *args, **kwargs):
         return kwargs[self._category](self, *args, **kwargs)
 
     def type_match(self, val):
+        if self._cache is not None:
+            return self._cache.type_match(self, val)
+        return self._type_match(val)
+
+    def _type_match(self, val):
         if 'validation' in self.restrictions:
             return type_match_definitions[self._category](self, val) and self.restrictions['validation'](val)
         else:
@@ -258,11 +679,124 @@ class TypeDefinition(object):
     def contents_match(self, val, key = None):
         return contents_match_definitions[self._category](self, val, key)
 
-    def proxy(self, val, do_invariant_checks):
+    def contents_match_many(self, values):
+        if self._category == sequence_name:
+            contents = self._contents
+            return all(contents.type_match(i) for i in values)
+        elif self._category == mapping_name:
+            key_contents, value_contents = self._key_contents, self._value_contents
+            return all(key_contents.type_match(k) and value_contents.type_match(v) for k, v in values)
+        return False
+
+    def type_match_prefix(self, val, count):
+        if self._category == sequence_name:
+            contents = islice(raw_values(val), count) if isinstance(val, self._container) else ()
+            matched = isinstance(val, self._container) and all(self.contents_match(i) for i in contents)
+        elif self._category == mapping_name:
+            contents = islice(raw_items(val), count) if isinstance(val, self._container) else ()
+            matched = isinstance(val, self._container) and all(self.contents_match(v, k) for k, v in contents)
+        else:
+            return self.type_match(val)
+        if 'validation' in self.restrictions:
+            return matched and self.restrictions['validation'](val)
+        return matched
+
+    def intern(self, val):
+        if self._interner is None:
+            return val
+        return self._interner(val)
+
+    def intern_contents(self, val):
+        if self._category == tuple_name:
+            return tuple(i.intern(v) for i, v in izip(self._tuple_contents, val))
+        elif self._category == sequence_name:
+            return [self._contents.intern(i) for i in raw_values(val)]
+        elif self._category == mapping_name:
+            return [(self._key_contents.intern(k), self._value_contents.intern(v)) for k, v in raw_items(val)]
+        else:
+            return self.intern(val)
+
+    def intern_many(self, values):
+        if not self._interns:
+            return values
+        elif self._category == sequence_name:
+            return [self._contents.intern(i) for i in values]
+        return [(self._key_contents.intern(k), self._value_contents.intern(v)) for k, v in values]
+
+    def proxy(self, val, do_invariant_checks, trusted = False, lock = None, tracker = None, policy = None):
+        if self._interns:
+            val = self.intern_contents(val)
+        if self._category == leaf_name:
+            return val
+        elif trusted:
+            return self._adopt(val).withtrusted(self, do_invariant_checks, lock, tracker, policy)
+        else:
+            return (self._adopt(val).withtype(self).withinvariants(do_invariant_checks)
+                .withlock(lock).withtracker(tracker).withpolicy(policy))
+
+    def _adopt(self, val):
+        if type(val) is self._proxy and (val._type_definition is None or val._type_definition is self) and \
+                val._tracker is None and val._parent is None and val._invariant_checks is None and \
+                val._lock is None:
+            return val
+        return self._proxy(self._copy(val))
+
+    def _copy(self, val):
+        if isinstance(val, dict):
+            return self._container(dict.iteritems(val))
+        return self._container(raw_values(val))
+
+    def unproxy(self, val):
+        if self._category == leaf_name:
+            return val
+        elif isinstance(val, (PersistentVector, PersistentMap)):
+            return thaw(val)
+        elif self._category == sequence_name and self._proxy is NestedListProxy:
+            return [self._contents.unproxy(i) for i in raw_values(val)]
+        elif self._category == mapping_name and self._proxy is NestedDictionaryProxy:
+            return dict((k, self._value_contents.unproxy(v)) for k, v in raw_items(val))
+        else:
+            return self._copy(val)
+
+    def clone(self, val, deep = True):
+        if self._category == leaf_name:
+            if deep and not self._immutable and hasattr(val, 'clone'):
+                return val.clone(deep)
+            return val
+        return self._copy(self.clone_contents(val, deep))
+
+    def clone_contents(self, val, deep = True):
+        if self._category == leaf_name:
+            return self.clone(val, deep)
+        elif not deep or self._leaf_only:
+            return val
+        elif self._category == tuple_name:
+            return tuple(i.clone(v, deep) for i, v in izip(self._tuple_contents, val))
+        elif self._category == sequence_name:
+            return [self._contents.clone(i, deep) for i in raw_values(val)]
+        else:
+            return [(k, self._value_contents.clone(v, deep)) for k, v in raw_items(val)]
+
+    def freeze(self, val):
+        if isinstance(val, (PersistentVector, PersistentMap)) and val._type_definition is self:
+            return val
+        val = thaw(val)
+        if not self.type_match(val):
+            raise TypeError('%s is not a %s' % (val, self))
+        return self._freeze(val)
+
+    def _freeze(self, val):
         if self._category == leaf_name:
+            return self.intern(val)
+        elif isinstance(val, (PersistentVector, PersistentMap)) and val._type_definition is self:
             return val
+        elif self._category == tuple_name:
+            return tuple(i._freeze(v) for i, v in izip(self._tuple_contents, val))
+        elif self._category == sequence_name:
+            return PersistentVector([self._contents._freeze(i) for i in raw_values(val)], self)
         else:
-            return self._proxy(val).withtype(self).withinvariants(do_invariant_checks)
+            return PersistentMap([(self._key_contents._freeze(k), self._value_contents._freeze(v))
+                for k, v in raw_items(val)], self)
 
     def _type_repr(self):
         if self._category == leaf_name:
@@ -1,17 +1,26 @@
 #/usr/bin/env python
 
+import re
+from copy import deepcopy
+from functools import partial
 from itertools import izip
 from xml.etree import ElementTree
 from magic import Object
+from type_definition import leaf_name, raw_values, raw_items
+import tagnameeditors
+
+_compact_item = re.compile(r'((?:[^,\\]|\\.)*),')
+_compact_escape = re.compile(r'\\(.)')
 
 class _xmlbehavior(object):
 
     _default_metanames = {  'item' : 'item', 'tuple' : 'tuple', 
                             'sequence' : 'sequence', 'mapping' : 'mapping' }
 
-    def __init__(self, tag_name_editor = None, display_attributes = True, metanames = None):
+    def __init__(self, tag_name_editor = None, display_attributes = True, metanames = None, compact = False):
         self.tag_name_editor = tag_name_editor
         self.display_attributes = display_attributes
+        self.compact = compact
         if metanames is None:
             self.metanames = _xmlbehavior._default_metanames
         else:
@@ -36,6 +45,8 @@ class _xmlbehavior(object):
             rval['display_attributes'] = 'false'
         if self.metanames != _xmlbehavior._default_metanames:
             rval['metanames'] = self.metanames
+        if self.compact:
+            rval['compact'] = 'true'
         if self.tag_name_editor is not None:
             if self.tag_name_editor.__module__ == 'tagnameeditors':
                 rval['tag_name_editor'] = 'builtin:%s' % self.tag_name_editor.__name__
@@ -45,14 +56,23 @@ class _xmlbehavior(object):
             
 class _xml(object):
     
-    def to_xml(self, node = None, behavior = _xmlbehavior()):
+    def to_xml(self, node = None, behavior = _xmlbehavior(), changed_only = False):
         if node is None:
             node = ElementTree.Element(behavior.rename(type(self).__name__))
         else:
             node = ElementTree.SubElement(node, behavior.rename(type(self).__name__))
         for k, v in behavior.description.items():
             node.set(k, str(v))
+        lazy = self.__dict__.get('__ultra_lazy__', {})
+        dialect = _xml._dialect(node) if lazy else None
         for property_name, type_description in type(self)._sorted_properties():
+            if changed_only and property_name not in self.__ultra_dirty__:
+                continue
+            if property_name in lazy and property_name not in self.__ultra_dirty__ and \
+                    lazy[property_name][2] == dialect and \
+                    (property_name not in self.__dict__ or not _xml._holds_objects(type_description)):
+                node.append(deepcopy(lazy[property_name][0]))
+                continue
             child = ElementTree.SubElement(node, behavior.rename(property_name))
             if behavior.display_attributes:
                 child.set('type', str(type_description))
@@ -68,6 +88,17 @@ class _xml(object):
 
         return node
         
+    @staticmethod
+    def _holds_objects(type_description):
+        return type_description.subhandler(
+            leaf = lambda type_description, **kwargs: hasattr(type_description._type, '__ultra__') and
+                not type_description._type.__ultra_frozen__,
+            tuple = lambda type_description, **kwargs: any(_xml._holds_objects(i)
+                for i in type_description._tuple_contents),
+            sequence = lambda type_description, **kwargs: _xml._holds_objects(type_description._contents),
+            mapping = lambda type_description, **kwargs: _xml._holds_objects(type_description._key_contents) or
+                _xml._holds_objects(type_description._value_contents))
+
     @staticmethod
     def child_node(node, val, val_type, behavior):
         if not isinstance(val, Object):
@@ -90,10 +121,37 @@ class _xml(object):
         else:
             node.text = str(val)
         
+    @staticmethod
+    def _compactable(*type_descriptions):
+        return all(i._category == leaf_name and i._immutable for i in type_descriptions)
+
+    @staticmethod
+    def _to_compact(type_description, val):
+        if issubclass(type_description._type, basestring):
+            return val.replace('\\', '\\\\').replace(',', '\\,') + ','
+        return str(val) + ','
+
+    @staticmethod
+    def _from_compact(node):
+        if not node.text:
+            return []
+        elif '\\' not in node.text:
+            return node.text.split(',')[:-1]
+        return [_compact_escape.sub(r'\1', i) for i in _compact_item.findall(node.text)]
+
+    @staticmethod
+    def _from_compact_leaf(type_description, text):
+        if type_description._interner is None:
+            return type_description._type(text)
+        return type_description.intern(type_description._type(text))
+
     @staticmethod
     def _to_sequence_xml(type_description, node, val, behavior, **kwargs):
         contents = type_description._contents
-        for item in val:
+        if behavior.compact and _xml._compactable(contents):
+            node.text = ''.join(_xml._to_compact(contents, item) for item in raw_values(val))
+            return
+        for item in raw_values(val):
             child = _xml.child_node(node, item, contents, behavior)
             contents.subhandler(child, item, behavior, **kwargs)
             
@@ -101,7 +159,11 @@ class _xml(object):
     def _to_mapping_xml(type_description, node, val, behavior, **kwargs):
         key_contents = type_description._key_contents
         value_contents = type_description._value_contents
-        for key, value in val.items():
+        if behavior.compact and _xml._compactable(key_contents, value_contents):
+            node.text = ''.join(_xml._to_compact(key_contents, key) + _xml._to_compact(value_contents, value)
+                for key, value in raw_items(val))
+            return
+        for key, value in raw_items(val):
             key_node = _xml.child_node(node, key, key_contents, behavior)
             value_node = _xml.child_node(node, value, value_contents, behavior)
             key_contents.subhandler(key_node, key, behavior, **kwargs)
@@ -110,6 +172,9 @@ class _xml(object):
     @staticmethod
     def _to_tuple_xml(type_description, node, val, behavior, **kwargs):
         contents = type_description._tuple_contents
+        if behavior.compact and _xml._compactable(*contents):
+            node.text = ''.join(_xml._to_compact(value_type, value) for value_type, value in izip(contents, val))
+            return
         for value_type, value in izip(contents, val):
             child = _xml.child_node(node, value, value_type, behavior)
             value_type.subhandler(child, value, behavior, **kwargs)
@@ -117,16 +182,25 @@ class _xml(object):
     @staticmethod
     def _from_leaf_xml(type_description, self, node, behavior, **kwargs):
         if len(node) == 0:
-            return type_description._type(node.text)
+            return type_description.intern(type_description._type(node.text))
         else:
-            return type_description._type.from_xml(node)
+            return type_description._type.from_xml(node, lazy = kwargs.get('lazy', False))
             
     @staticmethod
     def _from_sequence_xml(type_description, self, node, behavior, **kwargs):
+        contents = type_description._contents
+        if behavior.compact and _xml._compactable(contents):
+            return [_xml._from_compact_leaf(contents, item) for item in _xml._from_compact(node)]
         return [type_description._contents.subhandler(self, item, behavior, **kwargs) for item in node]
             
     @staticmethod
     def _from_mapping_xml(type_description, self, node, behavior, **kwargs):
+        key_contents = type_description._key_contents
+        value_contents = type_description._value_contents
+        if behavior.compact and _xml._compactable(key_contents, value_contents):
+            items = _xml._from_compact(node)
+            return dict((_xml._from_compact_leaf(key_contents, key), _xml._from_compact_leaf(value_contents, value))
+                for key, value in izip(items[0::2], items[1::2]))
         key_list = [y for x, y in enumerate(node) if (x % 2) == 0]
         value_list = [y for x, y in enumerate(node) if (x % 2) == 1]
         keys = [type_description._key_contents.subhandler(self, item, behavior, **kwargs) 
@@ -137,13 +211,48 @@ class _xml(object):
         
     @staticmethod
     def _from_tuple_xml(type_description, self, node, behavior, **kwargs):
+        if behavior.compact and _xml._compactable(*type_description._tuple_contents):
+            return tuple([_xml._from_compact_leaf(child_type, child)
+                for child, child_type in izip(_xml._from_compact(node), type_description._tuple_contents)])
         return tuple([child_type.subhandler(self, child, behavior, **kwargs) 
             for child, child_type in izip(node, type_description._tuple_contents)])
         
     @classmethod
-    def from_xml(cls, node, behavior = None):
+    def from_xml(cls, node, behavior = None, lazy = False):
         rval = cls()
-        
+        if cls.__ultra_frozen__:
+            rval = rval.evolve(**dict(cls._values_from_xml(node, behavior, lazy)))
+        elif lazy:
+            behavior = _xml._behavior_from_xml(node, behavior)
+            rval.__ultra_lazy__ = {}
+            dialect = _xml._dialect(node)
+            for tag, type_description, child in cls._children_from_xml(node, behavior):
+                rval.__dict__.pop(tag, None)
+                rval.__ultra_lazy__[tag] = (child, partial(_xml._from_property_xml, cls, type_description, child,
+                    behavior, True), dialect)
+        else:
+            rval.merge_xml(node, behavior)
+        rval.mark_clean()
+        return rval
+
+    def merge_xml(self, node, behavior = None):
+        for tag, val in type(self)._values_from_xml(node, behavior):
+            setattr(self, tag, val)
+        return self
+
+    @classmethod
+    def _values_from_xml(cls, node, behavior = None, lazy = False):
+        behavior = _xml._behavior_from_xml(node, behavior)
+        return [(tag, _xml._from_property_xml(cls, type_description, child, behavior, lazy))
+            for tag, type_description, child in cls._children_from_xml(node, behavior)]
+
+    @staticmethod
+    def _dialect(node):
+        return dict((k, node.get(k)) for k in ('display_attributes', 'metanames', 'tag_name_editor', 'compact')
+            if node.get(k) is not None)
+
+    @staticmethod
+    def _behavior_from_xml(node, behavior):
         if behavior is None:
             display_attributes = node.get('display_attributes')
             metanames = node.get('metanames')
@@ -156,10 +265,13 @@ class _xml(object):
                     tag_name_editor = None
             behavior = _xmlbehavior(display_attributes = display_attributes, 
                 metanames = metanames,
-                tag_name_editor = tag_name_editor)
-                
+                tag_name_editor = tag_name_editor,
+                compact = node.get('compact') == 'true')
+        return behavior
+
+    @classmethod
+    def _children_from_xml(cls, node, behavior):
         for child in node:
-            unrenamed_tag_choices = behavior.unrename(child.tag)
             tag = None
             for tag_name in behavior.unrename(child.tag):
                 if tag_name in cls.__ultra__:
@@ -167,18 +279,19 @@ class _xml(object):
                         tag = tag_name
                     else:
                         raise ValueError()
-            type_description = cls.__ultra__[tag][1]
-            val = type_description.subhandler(
-                rval, 
-                child,
-                behavior,
-                leaf = _xml._from_leaf_xml,
-                tuple = _xml._from_tuple_xml,
-                sequence = _xml._from_sequence_xml,
-                mapping = _xml._from_mapping_xml)
-            
-            setattr(rval, tag, val)
-        return rval
+            yield tag, cls.__ultra__[tag][1], child
+
+    @staticmethod
+    def _from_property_xml(cls, type_description, child, behavior, lazy = False):
+        return type_description.subhandler(
+            cls, 
+            child,
+            behavior,
+            leaf = _xml._from_leaf_xml,
+            tuple = _xml._from_tuple_xml,
+            sequence = _xml._from_sequence_xml,
+            mapping = _xml._from_mapping_xml,
+            lazy = lazy)
 
 
 if __name__ == '__main__':
@@ -228,6 +341,29 @@ if __name__ == '__main__':
             super(d, self).__init__()
             self.first_slot = replace_none(first, [])
     
+    class e(Object, _xml):
+        __ultra_frozen__ = True
+
+        first = Property([int])
+        second = Property({str: (int, float)})
+
+        def __init__(self, first = None, second = None):
+            super(e, self).__init__()
+            self.first = replace_none(first, [])
+            self.second = replace_none(second, {})
+
+    class f(Object, _xml):
+
+        first = Property([str])
+        second = Property({str: str})
+        third = Property((str, int))
+
+        def __init__(self, first = None, second = None, third = ('', 0)):
+            super(f, self).__init__()
+            self.first = replace_none(first, [])
+            self.second = replace_none(second, {})
+            self.third = third
+
     class Tests(unittest.TestCase):
     
         def setUp(self):
@@ -264,7 +400,97 @@ if __name__ == '__main__':
             
         def test_nesting(self):
             test_d2 = d.from_xml(self.test_d.to_xml(behavior = _xmlbehavior(tagnameeditors.capitalize)))
+            self.assertEqual(type(list.__getitem__(self.test_d.first_slot, 0)), list)
             self.assertEqual(test_d2.first_slot[0][1], self.test_d.first_slot[0][1])
+
+        def test_frozen(self):
+            test_e = e([1, 2, 3], {'a': (1, 1.5)})
+            test_e2 = e.from_xml(test_e.to_xml())
+            self.assertEqual(test_e2, test_e)
+            self.assertEqual(test_e2.changed_properties(), [])
+            self.assertRaises(TypeError, setattr, test_e2, 'first', [])
+
+        def test_changed_only(self):
+            test_b2 = b.from_xml(self.test_b.to_xml())
+            self.assertEqual(test_b2.changed_properties(), [])
+            test_b2.second.__setitem__(5, 8)
+            xml = test_b2.to_xml(changed_only = True)
+            self.assertEqual([i.tag for i in xml], ['second'])
+            self.test_b.merge_xml(xml)
+            self.assertEqual(self.test_b.second, {0: 1, 1: 3, 5: 8})
+            self.assertEqual(self.test_b.first, [1, 2, 3])
+
+        def test_compact(self):
+            compact = _xmlbehavior(compact = True)
+            xml = self.test_b.to_xml(behavior = compact)
+            self.assertEqual(xml.get('compact'), 'true')
+            self.assertEqual(xml.find('first').text, '1,2,3,')
+            self.assertEqual(xml.find('third').text, 'a,0,1.0,')
+            test_b2 = b.from_xml(ElementTree.fromstring(ElementTree.tostring(xml)))
+            self.assertEqual((test_b2.first, test_b2.second, test_b2.third),
+                (self.test_b.first, self.test_b.second, self.test_b.third))
+            test_d2 = d.from_xml(self.test_d.to_xml(behavior = compact))
+            self.assertEqual(test_d2.first_slot, [[2, 4, 6], [1, 3, 5]])
+            test_c2 = c.from_xml(self.test_c.to_xml(behavior = compact))
+            self.assertEqual(test_c2.first[0].second, 'four')
+
+        def test_compact_escaping(self):
+            test_f = f(['a,b', '', 'c\\d', '\\,'], {'': ',', 'k\\': 'v'}, ('x,y', 3))
+            xml = ElementTree.tostring(test_f.to_xml(behavior = _xmlbehavior(compact = True)))
+            test_f2 = f.from_xml(ElementTree.fromstring(xml))
+            self.assertEqual((test_f2.first, test_f2.second, test_f2.third),
+                (test_f.first, test_f.second, test_f.third))
+            self.assertEqual(f.from_xml(f([''], {}).to_xml(behavior = _xmlbehavior(compact = True))).first, [''])
+            self.assertEqual(f.from_xml(f().to_xml(behavior = _xmlbehavior(compact = True))).first, [])
+
+        def test_compact_size(self):
+            test_b = b()
+            test_b.first = range(1000)
+            test_b.second = dict((i, i * 2) for i in xrange(1000))
+            default = len(ElementTree.tostring(test_b.to_xml()))
+            compact = len(ElementTree.tostring(test_b.to_xml(behavior = _xmlbehavior(compact = True))))
+            self.assertTrue(default > compact * 5)
+
+        def test_lazy(self):
+            xml = self.test_b.to_xml()
+            test_b2 = b.from_xml(xml, lazy = True)
+            self.assertEqual(sorted(test_b2.__ultra_lazy__), ['first', 'second', 'third'])
+            self.assertEqual(test_b2.first, [1, 2, 3])
+            self.assertRaises(TypeError, test_b2.first.append, 'a')
+            self.assertEqual(sorted(test_b2.__ultra_lazy__), ['first', 'second', 'third'])
+            self.assertEqual(ElementTree.tostring(test_b2.to_xml()), ElementTree.tostring(xml))
+            xml.find('first').set('source', 'kept')
+            test_b4 = b.from_xml(xml, lazy = True)
+            self.assertEqual(test_b4.first, [1, 2, 3])
+            self.assertEqual(test_b4.to_xml().find('first').get('source'), 'kept')
+            test_b4.first.append(4)
+            test_b4.mark_clean()
+            self.assertEqual(test_b4.to_xml().find('first').get('source'), None)
+            self.assertEqual(b.from_xml(test_b4.to_xml()).first, [1, 2, 3, 4])
+            test_b2.second.__setitem__(5, 8)
+            test_b2.third = ('b', 1, 2.0)
+            self.assertEqual(test_b2.changed_properties(), ['second', 'third'])
+            test_b3 = b.from_xml(test_b2.to_xml())
+            self.assertEqual((test_b3.first, test_b3.second, test_b3.third), ([1, 2, 3], {0: 1, 1: 3, 5: 8}, ('b', 1, 2.0)))
+            self.assertEqual(test_b2.clone().second, {0: 1, 1: 3, 5: 8})
+
+        def test_lazy_errors(self):
+            xml = self.test_b.to_xml()
+            xml.find('first')[0].text = 'x'
+            test_b2 = b.from_xml(xml, lazy = True)
+            self.assertEqual(test_b2.third, ('a', 0, 1.0))
+            self.assertRaises(ValueError, getattr, test_b2, 'first')
+
+        def test_lazy_nested(self):
+            test_c2 = c.from_xml(self.test_c.to_xml(), lazy = True)
+            inner = test_c2.first[0]
+            self.assertEqual(sorted(inner.__ultra_lazy__), ['first', 'second', 'third'])
+            self.assertEqual(inner.second, 'four')
+            xml = test_c2.to_xml(behavior = _xmlbehavior(display_attributes = False))
+            self.assertEqual(xml.find('first').get('type'), None)
+            self.assertEqual(xml.find('first/a/third').text, '4.01')
+            inner.second = 'five'
+            self.assertEqual(test_c2.to_xml().find('first/a/second').text, 'five')
                 
     suite = unittest.TestLoader().loadTestsFromTestCase(Tests)
     unittest.TextTestRunner(verbosity=2).run(suite)